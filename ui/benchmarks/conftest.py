@@ -0,0 +1,219 @@
+"""Benchmarks of the data, map and chart hot paths at production scale.
+
+Payloads are produced by the real pipes of tinybird/, run by the local
+Tinybird stand-in over synthetic data, so they have the same shape as the
+production CSV responses. Each benchmark records wall time, peak memory,
+payload size and (for data frames) the number of rows. Payload sizes, rows
+and peak memory only depend on the locked library versions, so their
+baseline is versioned and every run is compared with it. Wall time depends
+on the machine, so it is recorded locally and only compared when asked to
+(--compare-time). Both are recorded with --update-baseline.
+"""
+
+import datetime
+import functools
+import importlib
+import io
+import json
+import os
+import tracemalloc
+
+import pandas as pd
+import pytest
+
+from valencianow import data, launcher, localbird, synthetic
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+# not versioned, timings are only comparable on the machine that recorded them
+TIMINGS_PATH = os.path.join(BENCHMARKS_DIR, "..", ".benchmarks", "timings.json")
+# metrics recorded in TIMINGS_PATH, the others go to BASELINE_PATH
+TIMED = ("mean",)
+TINYBIRD_DIR = os.path.join(BENCHMARKS_DIR, "..", "..", "tinybird")
+# fixed end of the synthetic data, so that payloads are reproducible
+END = datetime.datetime(2026, 3, 2)
+TIMESPANS = {"Today": 1, "Last Week": 7, "Last Month": 31, "Last Year": 365}
+# sensors with a full year of history, also the ones used for comparisons
+HISTORY_SENSORS = 10
+# allowed growth of each metric over the baseline before a benchmark fails.
+# Peak memory moves a bit with the order of the tests (shared caches) and
+# wall time with the load of the machine, so their tolerances are wider.
+# Rows must match exactly, fewer of them are a regression too
+TOLERANCE = {"payload": 0.1, "rows": 0.0, "peak_memory": 0.5, "mean": 1.0}
+# the plotting libraries are imported lazily, but always loaded in the running
+# application (the launcher preloads them), which changes plotly's allocations
+for module in launcher.RENDER_MODULES:
+    importlib.import_module(module)
+
+DATASOURCES = {
+    config_label: datasource
+    for datasource, config_label in synthetic.SENSOR_TYPES.items()
+}
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--update-baseline",
+        action="store_true",
+        help="record the results of this run as the new baseline",
+    )
+    parser.addoption(
+        "--compare-time",
+        action="store_true",
+        help="also fail the benchmarks slower than the locally recorded timings",
+    )
+
+
+def pytest_configure(config):
+    config.baseline_results = {}
+
+
+def pytest_sessionfinish(session):
+    results = session.config.baseline_results
+    if not session.config.getoption("--update-baseline") or not results:
+        return
+    for path, timed in ((BASELINE_PATH, False), (TIMINGS_PATH, True)):
+        baseline = _load_baseline(path)
+        baseline.update(
+            {
+                name: {
+                    metric: round(value, 6)
+                    for metric, value in metrics.items()
+                    if (metric in TIMED) == timed
+                }
+                for name, metrics in results.items()
+            }
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+
+
+def _load_baseline(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _regressed(metric: str, value: float, baseline: float) -> bool:
+    if metric == "rows":
+        return value != baseline
+    return value > baseline * (1 + TOLERANCE[metric])
+
+
+def _format(metric: str, value: float) -> str:
+    if metric == "rows":
+        return f"{value:.0f} rows"
+    return f"{value * 1000:.2f} ms" if metric == "mean" else f"{value / 1024:.1f} KiB"
+
+
+def read_payload(payload: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(payload), na_values=["\\N"])
+
+
+@pytest.fixture(scope="session")
+def tinybird(tmp_path_factory) -> localbird.LocalTinybird:
+    """Local Tinybird with a year of history for the first sensors of each
+    datasource, and the last day for all of them."""
+    data_dir = tmp_path_factory.mktemp("tinybird")
+    day_start = END - datetime.timedelta(days=1)
+    year_start = END - datetime.timedelta(days=TIMESPANS["Last Year"])
+    for datasource in synthetic.DATASOURCES:
+        os.makedirs(data_dir / datasource)
+        year = synthetic.readings(datasource, year_start, day_start, HISTORY_SENSORS)
+        year.to_parquet(data_dir / datasource / "year.parquet", index=False)
+        day = synthetic.readings(datasource, day_start, END)
+        day.to_parquet(data_dir / datasource / "day.parquet", index=False)
+    return localbird.LocalTinybird(TINYBIRD_DIR, str(data_dir))
+
+
+@pytest.fixture(scope="session")
+def payload(tinybird):
+    """CSV response of a pipe, as returned by Tinybird."""
+
+    @functools.cache
+    def get(pipe: str, **params) -> bytes:
+        return tinybird.query_pipe(pipe, params)
+
+    return get
+
+
+@pytest.fixture(scope="session")
+def sensors():
+    """Ids of the sensors with a full year of history, by sensor type."""
+    return {
+        label: synthetic.sensors(datasource, HISTORY_SENSORS)["id"].tolist()
+        for label, datasource in DATASOURCES.items()
+    }
+
+
+def history_params(timespan: str) -> dict:
+    min_date = END - datetime.timedelta(days=TIMESPANS[timespan])
+    return {"min_date": min_date.strftime("%Y-%m-%d %H:%M:%S"), "lean": "true"}
+
+
+@pytest.fixture
+def serve(monkeypatch, payload):
+    """Make load_data read the given payloads instead of calling Tinybird.
+
+    Requests to other pipes (like the positions of unknown sensors) are
+    answered by the local Tinybird, and cached.
+    """
+
+    def patch(payloads: dict[str, bytes]) -> None:
+        def fetch(pipe_name: str, params: dict) -> pd.DataFrame:
+            # non-lean requests to lean pipes only ask for sensor positions
+            measured = params.get("lean") or pipe_name not in data.LEAN_PIPES
+            if pipe_name in payloads and measured:
+                return read_payload(payloads[pipe_name])
+            return read_payload(payload(pipe_name, **params))
+
+        monkeypatch.setattr(data, "_fetch", fetch)
+
+    return patch
+
+
+@pytest.fixture
+def measure(request, benchmark):
+    """Benchmark a function, and compare its results with the baseline.
+
+    `payload_size` gets the size in bytes of the result of the function (or
+    of the payload it processes).
+    """
+
+    def run(func, payload_size=None):
+        result = benchmark(func)
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results = {"peak_memory": peak}
+        if payload_size is not None:
+            results["payload"] = payload_size(result)
+        if isinstance(result, pd.DataFrame):
+            results["rows"] = len(result)
+        if benchmark.stats is not None:
+            results["mean"] = benchmark.stats.stats.mean
+        benchmark.extra_info.update(results)
+
+        name = request.node.name
+        if request.config.getoption("--update-baseline"):
+            request.config.baseline_results[name] = results
+            return result
+        baseline = _load_baseline(BASELINE_PATH).get(name, {})
+        if request.config.getoption("--compare-time"):
+            baseline.update(_load_baseline(TIMINGS_PATH).get(name, {}))
+        regressions = [
+            f"{metric}: {_format(metric, value)}, baseline "
+            f"{_format(metric, baseline[metric])} (+{TOLERANCE[metric]:.0%} allowed)"
+            for metric, value in results.items()
+            if metric in baseline and _regressed(metric, value, baseline[metric])
+        ]
+        if regressions:
+            pytest.fail(f"Regression in {name}:\n" + "\n".join(regressions))
+        return result
+
+    return run
@@ -0,0 +1,101 @@
+"""building and serializing the plotly charts (valencianow.components)"""
+
+import pytest
+from conftest import TIMESPANS, history_params, read_payload
+
+from valencianow import components, config, data
+
+LABELS = list(data.TB_PIPES)
+
+
+def _figure_json(build):
+    return lambda: build().to_json()
+
+
+@pytest.mark.parametrize("timespan", TIMESPANS)
+@pytest.mark.parametrize("label", LABELS)
+def test_historical_figure(label, timespan, measure, payload, sensors):
+    info = data.TB_PIPES[label]
+    params = {**history_params(timespan), info[data.TB_SENSOR_PARAM]: sensors[label][0]}
+    rows = data._process(read_payload(payload(info[data.TB_HIST_PIPE], **params)))
+    y_axis = info[data.TB_HIST_Y]
+    measure(
+        _figure_json(lambda: components.historical_figure(rows, y_axis)),
+        payload_size=len,
+    )
+
+
+@pytest.mark.parametrize("timespan", TIMESPANS)
+@pytest.mark.parametrize("label", LABELS)
+def test_comparison_figure(label, timespan, measure, payload, sensors):
+    info = data.TB_PIPES[label]
+    ids = ",".join(str(sid) for sid in sensors[label])
+    params = {**history_params(timespan), info[data.TB_SENSORS_PARAM]: ids}
+    rows = data._process(read_payload(payload(info[data.TB_HIST_PIPE], **params)))
+    y_axis = info[data.TB_HIST_Y]
+    measure(
+        _figure_json(lambda: components.comparison_figure(rows, label, y_axis)),
+        payload_size=len,
+    )
+
+
+@pytest.mark.parametrize("timespan", ["Last Month", "Last Year"])
+@pytest.mark.parametrize("label", LABELS)
+def test_per_day_figures(label, timespan, measure, payload, sensors):
+    info = data.TB_PIPES[label]
+    params = {**history_params(timespan), info[data.TB_SENSOR_PARAM]: sensors[label][0]}
+    params.pop("lean")
+    per_day = data._process(read_payload(payload(info[data.TB_PER_DAY_PIPE], **params)))
+    per_dow = data._process(read_payload(payload(info[data.TB_PER_DOW_PIPE], **params)))
+
+    def build():
+        return (
+            components.per_day_figure(per_day, info[data.TB_PER_DAY_Y]).to_json()
+            + components.per_day_of_week_figure(
+                per_dow.copy(), info[data.TB_PER_DOW_Y]
+            ).to_json()
+        )
+
+    measure(build, payload_size=len)
+
+
+@pytest.mark.parametrize("timespan", TIMESPANS)
+def test_pollutant_figures(timespan, measure, payload):
+    info = data.TB_PIPES[config.TAB_AIR]
+    params = {**history_params(timespan), "pollutant": "no2"}
+    params.pop("lean")
+    history = data._process(
+        read_payload(payload(info[data.TB_POLLUTANT_HIST_PIPE], **params))
+    )
+    per_day = data._process(
+        read_payload(payload(info[data.TB_POLLUTANT_PER_DAY_PIPE], **params))
+    )
+
+    def build():
+        return (
+            components.pollutant_history_figure(history, "no2").to_json()
+            + components.pollutant_per_day_figure(per_day, "no2").to_json()
+        )
+
+    measure(build, payload_size=len)
+
+
+def test_pollutant_city_mean(payload):
+    """The whole city chart has a line with the mean of the stations."""
+    info = data.TB_PIPES[config.TAB_AIR]
+    params = {**history_params("Last Week"), "pollutant": "no2"}
+    params.pop("lean")
+    history = data._process(
+        read_payload(payload(info[data.TB_POLLUTANT_HIST_PIPE], **params))
+    )
+    fig = components.pollutant_history_figure(history, "no2")
+    (city,) = [trace for trace in fig.data if trace.name == components.CITY_MEAN]
+    expected = history.groupby(data.COL_DATETIME)["value"].mean()
+    assert list(city.y) == pytest.approx(expected.tolist())
+    assert len(fig.data) == history[data.COL_SENSOR].nunique() + 1
+
+    station = history.loc[history[data.COL_SENSOR] == history[data.COL_SENSOR].iloc[0]]
+    fig = components.pollutant_history_figure(station, "no2")
+    assert [
+        trace.name for trace in fig.data if trace.name == components.CITY_MEAN
+    ] == []
@@ -0,0 +1,410 @@
+"""parsing and normalization of the Tinybird responses (valencianow.data)"""
+
+import datetime
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import END, TIMESPANS, history_params, read_payload
+
+from valencianow import config, data, mirror, sharedcache
+
+LABELS = list(data.TB_PIPES)
+
+
+@pytest.fixture(scope="module")
+def mirrored(tmp_path_factory, payload):
+    """Local mirror with all the readings of the local Tinybird, synced up to
+    the end of the synthetic data."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(mirror, "MIRROR_DIR", str(tmp_path_factory.mktemp("mirror")))
+        params = history_params("Last Year")
+        since = datetime.datetime.strptime(params["min_date"], mirror.DATE_FORMAT)
+        for label, info in data.TB_PIPES.items():
+            response = read_payload(payload(info[data.TB_HIST_PIPE], **params))
+            mirror.write(label, mirror.to_readings(label, response))
+            mirror._save_state(label, since, END)
+        yield
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_parse_now(label, measure, payload):
+    csv = payload(data.TB_PIPES[label][data.TB_NOW_PIPE], lean="true")
+    measure(lambda: read_payload(csv), payload_size=lambda _: len(csv))
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_load_now(label, measure, payload, serve):
+    pipe = data.TB_PIPES[label][data.TB_NOW_PIPE]
+    csv = payload(pipe, lean="true")
+    serve({pipe: csv})
+    measure(lambda: data.load_data(pipe, None), payload_size=lambda _: len(csv))
+
+
+def test_unknown_positions_fetched_once(payload, monkeypatch):
+    """Positions of the sensors missing from the static table are requested
+    once, and kept for the next responses."""
+    pipe = data.TB_PIPES[config.TAB_CAR][data.TB_NOW_PIPE]
+    fetched = []
+
+    def fetch(pipe_name: str, params: dict) -> pd.DataFrame:
+        fetched.append(params.get("lean", "false"))
+        return read_payload(payload(pipe_name, **params))
+
+    monkeypatch.setattr(data, "_fetch", fetch)
+    monkeypatch.setattr(data, "_fetched_locations", {})
+    first = data.load_data(pipe, None)
+    second = data.load_data(pipe, None)
+    assert fetched == ["true", "false", "true"]
+    assert first is not None and second is not None
+    assert first[[data.COL_LAT, data.COL_LON]].notna().all().all()
+    pd.testing.assert_frame_equal(first, second)
+
+
+@pytest.mark.parametrize("timespan", TIMESPANS)
+@pytest.mark.parametrize("label", LABELS)
+def test_load_history(label, timespan, measure, payload, serve, sensors):
+    info = data.TB_PIPES[label]
+    pipe, sensor = info[data.TB_HIST_PIPE], sensors[label][0]
+    params = {**history_params(timespan), info[data.TB_SENSOR_PARAM]: sensor}
+    csv = payload(pipe, **params)
+    serve({pipe: csv})
+    measure(
+        lambda: data.load_data(
+            pipe,
+            None,
+            sensor,
+            filter_timespan=timespan,
+            sensor_param=info[data.TB_SENSOR_PARAM],
+        ),
+        payload_size=lambda _: len(csv),
+    )
+
+
+@pytest.mark.parametrize("timespan", TIMESPANS)
+@pytest.mark.parametrize("label", LABELS)
+def test_load_comparison(label, timespan, measure, payload, serve, sensors):
+    info = data.TB_PIPES[label]
+    pipe, sensors_param = info[data.TB_HIST_PIPE], info[data.TB_SENSORS_PARAM]
+    ids = ",".join(str(sid) for sid in sensors[label])
+    csv = payload(pipe, **history_params(timespan), **{sensors_param: ids})
+    serve({pipe: csv})
+    measure(
+        lambda: data.load_data(
+            pipe,
+            None,
+            filter_sensors=sensors[label],
+            filter_timespan=timespan,
+            sensors_param=sensors_param,
+        ),
+        payload_size=lambda _: len(csv),
+    )
+
+
+@pytest.mark.parametrize("pipe_key", [data.TB_PER_DAY_PIPE, data.TB_PER_DOW_PIPE])
+@pytest.mark.parametrize("timespan", ["Last Month", "Last Year"])
+@pytest.mark.parametrize("label", LABELS)
+def test_load_aggregated(label, timespan, pipe_key, measure, payload, serve, sensors):
+    info = data.TB_PIPES[label]
+    pipe, sensor = info[pipe_key], sensors[label][0]
+    params = {**history_params(timespan), info[data.TB_SENSOR_PARAM]: sensor}
+    params.pop("lean")
+    csv = payload(pipe, **params)
+    serve({pipe: csv})
+    measure(
+        lambda: data.load_data(
+            pipe,
+            None,
+            sensor,
+            filter_timespan=timespan,
+            sensor_param=info[data.TB_SENSOR_PARAM],
+        ),
+        payload_size=lambda _: len(csv),
+    )
+
+
+@pytest.mark.parametrize("label", [config.TAB_CAR, config.TAB_BIKE])
+def test_load_kpis(label, measure, payload, serve):
+    """City-wide KPIs, read from the per interval rollup."""
+    pipe = data.TB_PIPES[label][data.TB_KPIS_PIPE]
+    csv = payload(pipe, max_date=END.strftime("%Y-%m-%d %H:%M:%S"))
+    serve({pipe: csv})
+    measure(lambda: data.load_data(pipe, None), payload_size=lambda _: len(csv))
+
+
+@pytest.mark.parametrize(
+    "pipe_key", [data.TB_POLLUTANT_HIST_PIPE, data.TB_POLLUTANT_PER_DAY_PIPE]
+)
+@pytest.mark.parametrize("timespan", TIMESPANS)
+def test_load_pollutant(timespan, pipe_key, measure, payload, serve):
+    """Whole city, read from the hourly pollutant rollup."""
+    pipe = data.TB_PIPES[config.TAB_AIR][pipe_key]
+    params = {**history_params(timespan), "pollutant": "no2"}
+    params.pop("lean")
+    csv = payload(pipe, **params)
+    serve({pipe: csv})
+    measure(
+        lambda: data.load_data(pipe, None, filter_timespan=timespan, pollutant="no2"),
+        payload_size=lambda _: len(csv),
+    )
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_shared_history_read(
+    label, measure, payload, serve, sensors, monkeypatch, tmp_path
+):
+    info = data.TB_PIPES[label]
+    pipe, sensor = info[data.TB_HIST_PIPE], sensors[label][0]
+    params = {**history_params("Last Year"), info[data.TB_SENSOR_PARAM]: sensor}
+    serve({pipe: payload(pipe, **params)})
+    monkeypatch.setattr(sharedcache, "CACHE_DIR", str(tmp_path))
+
+    def load():
+        return data.load_data(
+            pipe,
+            None,
+            sensor,
+            filter_timespan="Last Year",
+            sensor_param=info[data.TB_SENSOR_PARAM],
+        )
+
+    load()  # stored by the first call, read by the measured ones
+    (stored,) = tmp_path.glob("*.arrow")
+    measure(load, payload_size=lambda _: stored.stat().st_size)
+
+
+def test_shared_cache_eviction(monkeypatch, tmp_path):
+    """Snapshots not refreshed for EVICT_AFTER_TTLS are deleted when another
+    one is refreshed, the recent ones are kept."""
+    monkeypatch.setattr(sharedcache, "CACHE_DIR", str(tmp_path))
+    ttl = 60
+    old = time.time() - (sharedcache.EVICT_AFTER_TTLS + 1) * ttl
+    for key in ("old|a", "old|b", "recent|a"):
+        sharedcache.get(key, lambda: pd.DataFrame({"x": [1]}), ttl)
+    for key in ("old|a", "old|b"):
+        os.utime(sharedcache.path(key), (old, old))
+    # the lock file of a snapshot that failed to load
+    orphan = tmp_path / "failed-0.arrow.lock"
+    orphan.touch()
+    os.utime(orphan, (old, old))
+    sharedcache.get("new|a", lambda: None, ttl)
+    kept = {sharedcache.path(key) for key in ("new|a", "recent|a")}
+    kept |= {f"{file}.lock" for file in kept}
+    assert {str(file) for file in tmp_path.iterdir()} == kept
+
+
+def _mapped_regions(file: str) -> list[tuple[int, int]]:
+    """Address ranges of this process where the given file is mapped."""
+    regions = []
+    with open("/proc/self/maps", encoding="utf-8") as f:
+        for line in f:
+            if line.rstrip().endswith(os.path.realpath(file)):
+                start, end = line.split()[0].split("-")
+                regions.append((int(start, 16), int(end, 16)))
+    return regions
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs procfs")
+def test_shared_cache_mapped_columns(monkeypatch, tmp_path):
+    """Numeric columns without nulls are views of the memory-mapped file, so
+    their pages are shared by the workers, instead of copies."""
+    monkeypatch.setattr(sharedcache, "CACHE_DIR", str(tmp_path))
+    n = 1_000_000
+    numeric = {
+        "ih": np.arange(n, dtype=np.int64),
+        data.COL_LAT: np.linspace(39.4, 39.5, n),
+        data.COL_DATETIME: pd.date_range(END, periods=n, freq="s"),
+    }
+    sharedcache.write("mapped", pd.DataFrame({**numeric, "name": "x"}))
+    stored = sharedcache.read("mapped")
+    assert stored is not None and stored[0] is not None
+    regions = _mapped_regions(sharedcache.path("mapped"))
+    assert regions
+    for column in numeric:
+        values = stored[0][column].to_numpy()
+        address = values.__array_interface__["data"][0]
+        assert any(start <= address < end for start, end in regions), column
+        assert not values.flags.writeable
+
+
+@pytest.mark.parametrize(
+    "pipe_key", [data.TB_HIST_PIPE, data.TB_PER_DAY_PIPE, data.TB_PER_DOW_PIPE]
+)
+@pytest.mark.parametrize("label", LABELS)
+def test_mirror_query(label, pipe_key, measure, sensors, mirrored):
+    info = data.TB_PIPES[label]
+    params = {
+        **history_params("Last Year"),
+        "max_date": END.strftime(mirror.DATE_FORMAT),
+        info[data.TB_SENSOR_PARAM]: str(sensors[label][0]),
+    }
+    if pipe_key != data.TB_HIST_PIPE:
+        params.pop("lean")
+    result = measure(
+        lambda: mirror.query(info[pipe_key], params),
+        payload_size=lambda df: int(df.memory_usage(deep=True).sum()),
+    )
+    assert result is not None and len(result) > 0
+
+
+def _mapped_regions(file: str) -> list[tuple[int, int]]:
+    """Address ranges of this process where the given file is mapped."""
+    regions = []
+    with open("/proc/self/maps", encoding="utf-8") as f:
+        for line in f:
+            if line.rstrip().endswith(os.path.realpath(file)):
+                start, end = line.split()[0].split("-")
+                regions.append((int(start, 16), int(end, 16)))
+    return regions
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs procfs")
+def test_shared_cache_mapped_columns(monkeypatch, tmp_path):
+    """Numeric columns without nulls are views of the memory-mapped file, so
+    their pages are shared by the workers, instead of copies."""
+    monkeypatch.setattr(sharedcache, "CACHE_DIR", str(tmp_path))
+    n = 1_000_000
+    numeric = {
+        "ih": np.arange(n, dtype=np.int64),
+        data.COL_LAT: np.linspace(39.4, 39.5, n),
+        data.COL_DATETIME: pd.date_range(END, periods=n, freq="s"),
+    }
+    sharedcache.write("mapped", pd.DataFrame({**numeric, "name": "x"}))
+    stored = sharedcache.read("mapped")
+    assert stored is not None and stored[0] is not None
+    regions = _mapped_regions(sharedcache.path("mapped"))
+    assert regions
+    for column in numeric:
+        values = stored[0][column].to_numpy()
+        address = values.__array_interface__["data"][0]
+        assert any(start <= address < end for start, end in regions), column
+        assert not values.flags.writeable
+
+
+@pytest.mark.parametrize(
+    "pipe_key", [data.TB_HIST_PIPE, data.TB_PER_DAY_PIPE, data.TB_PER_DOW_PIPE]
+)
+@pytest.mark.parametrize("label", LABELS)
+def test_mirror_matches_tinybird(label, pipe_key, payload, sensors, mirrored):
+    """The mirror gives the same frames as Tinybird, once processed."""
+    info = data.TB_PIPES[label]
+    params = {
+        **history_params("Last Month"),
+        "max_date": END.strftime(mirror.DATE_FORMAT),
+        info[data.TB_SENSOR_PARAM]: str(sensors[label][0]),
+    }
+    if pipe_key != data.TB_HIST_PIPE:
+        params.pop("lean")
+    expected = data._process(read_payload(payload(info[pipe_key], **params)))
+    result = data._process(mirror.query(info[pipe_key], params))
+    assert expected is not None and result is not None
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def _serve_windows(monkeypatch, payload, label: str) -> list[dict]:
+    """Answer the mirror syncs with the local Tinybird, returning the params of
+    their requests. Windows after the end of the synthetic data are empty."""
+    requests = []
+
+    def fetch(pipe_name: str, params: dict) -> pd.DataFrame:
+        requests.append(params)
+        if params["min_date"] >= END.strftime(mirror.DATE_FORMAT):
+            return pd.DataFrame(columns=list(mirror._columns(label)))
+        return read_payload(payload(pipe_name, **params))
+
+    monkeypatch.setattr(data, "_fetch", fetch)
+    return requests
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_mirror_sync_overlap(label, monkeypatch, payload, tmp_path):
+    """Readings of the overlap requested again are not mirrored twice, and a
+    sync right after another one requests nothing."""
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    requests = _serve_windows(monkeypatch, payload, label)
+    since = END - datetime.timedelta(days=2)
+    watermark = END - datetime.timedelta(hours=12)
+    mirror.write(label, mirror._fetch_window(label, since, watermark))
+    mirror._save_state(label, since, watermark - datetime.timedelta(seconds=1))
+    expected = mirror._fetch_window(label, since, END)
+
+    mirror.sync(label)
+    first_window = requests[2]["min_date"]
+    assert first_window < watermark.strftime(mirror.DATE_FORMAT)
+    sensor_col, datetime_col, _ = mirror._columns(label)
+    mirrored = mirror._read(label, since)
+    assert not mirrored.duplicated([sensor_col, datetime_col]).any()
+    assert len(mirrored) == len(expected)
+
+    requests.clear()
+    assert mirror.sync(label, min_interval=mirror.SYNC_INTERVAL) == 0
+    assert requests == []
+
+
+@pytest.mark.parametrize("label", LABELS)
+def test_mirror_late_readings(label, monkeypatch, payload, tmp_path):
+    """Only the PUBLISH_DELAY before the watermark is requested again, so
+    readings published that late are mirrored by the next sync, and later
+    ones only when requested with a longer overlap."""
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    requests = _serve_windows(monkeypatch, payload, label)
+    since = END - datetime.timedelta(days=1)
+    watermark = END - datetime.timedelta(hours=6)
+    delay = mirror.PUBLISH_DELAY
+    _, datetime_col, _ = mirror._columns(label)
+    readings = mirror._fetch_window(label, since, watermark)
+    times = readings[datetime_col]
+    # not published yet at the previous sync, within the delay
+    late = times >= watermark - delay / 2
+    # published even later, after an outage
+    very_late = (times >= watermark - 3 * delay) & (times < watermark - 2 * delay)
+    mirror.write(label, readings.loc[~late & ~very_late])
+    mirror._save_state(label, since, watermark - datetime.timedelta(seconds=1))
+    expected = mirror._fetch_window(label, since, END)
+
+    mirror.sync(label)
+    synced = watermark - datetime.timedelta(seconds=1) - delay
+    assert requests[2]["min_date"] == synced.strftime(mirror.DATE_FORMAT)
+    assert len(mirror._read(label, since)) == len(expected) - very_late.sum()
+
+    # the overlap is counted from the new watermark, the current time
+    current = mirror.state(label)
+    assert current is not None
+    mirror.sync(label, overlap=current["watermark"] - (watermark - 3 * delay))
+    assert len(mirror._read(label, since)) == len(expected)
+
+
+def test_stale_mirror_syncs_in_background(monkeypatch, tmp_path, sensors):
+    """Queries reaching the latest readings don't wait for an expired mirror
+    to sync: they go to Tinybird, and a single sync runs meanwhile."""
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    # any sync is expired
+    monkeypatch.setattr(mirror, "SYNC_INTERVAL", -1)
+    label = config.TAB_AIR
+    since = END - datetime.timedelta(days=2)
+    os.makedirs(mirror._dir(label))
+    mirror._save_state(label, since, END)
+    release, syncs = threading.Event(), []
+
+    def sync(label: str, days: int = 0, min_interval: float = 0) -> int:
+        syncs.append(min_interval)
+        release.wait(timeout=10)
+        return 0
+
+    monkeypatch.setattr(mirror, "sync", sync)
+    info = data.TB_PIPES[label]
+    params = {
+        "min_date": since.strftime(mirror.DATE_FORMAT),
+        "lean": "true",
+        info[data.TB_SENSOR_PARAM]: str(sensors[label][0]),
+    }
+    try:
+        assert mirror.query(info[data.TB_HIST_PIPE], params) is None
+        assert mirror.query(info[data.TB_HIST_PIPE], params) is None
+    finally:
+        release.set()
+        mirror._syncing[label].join(timeout=10)
+    assert syncs == [mirror.SYNC_INTERVAL]
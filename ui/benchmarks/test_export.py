@@ -0,0 +1,115 @@
+"""windowed export of the history to Parquet (valencianow.export)"""
+
+import datetime
+import tracemalloc
+
+import pyarrow.parquet as pq
+import pytest
+from conftest import END, TIMESPANS
+
+from valencianow import config, data, export
+
+# peak memory must not grow with the exported range
+EXPORT_WINDOW = datetime.timedelta(days=7)
+# windows exported before interrupting an export
+INTERRUPT_AFTER = 2
+# allowed growth of the peak memory of a year export over a month one
+MAX_PEAK_GROWTH = 1.5
+
+
+@pytest.mark.parametrize("timespan", ["Last Month", "Last Year"])
+@pytest.mark.parametrize("label", list(data.TB_PIPES))
+def test_export(label, timespan, measure, serve, sensors, tmp_path):
+    serve({})
+    out = tmp_path / "export.parquet"
+    start = END - datetime.timedelta(days=TIMESPANS[timespan])
+    measure(
+        lambda: export.export(
+            data.TB_PIPES[label][data.TB_HIST_PIPE],
+            str(out),
+            start,
+            END,
+            sensors[label],
+            EXPORT_WINDOW,
+        ),
+        payload_size=lambda _: out.stat().st_size,
+    )
+
+
+@pytest.mark.parametrize("label", list(data.TB_PIPES))
+def test_export_resume(label, monkeypatch, serve, sensors, tmp_path):
+    """An export interrupted after some windows only requests the others when
+    run again, and gives the same file as an uninterrupted one."""
+    serve({})
+    pipe = data.TB_PIPES[label][data.TB_HIST_PIPE]
+    start = END - datetime.timedelta(days=TIMESPANS["Last Month"])
+    args = (start, END, sensors[label], EXPORT_WINDOW)
+    full = tmp_path / "full.parquet"
+    export.export(pipe, str(full), *args)
+
+    export_window = export._export_window
+    exported, limit = [], [INTERRUPT_AFTER]
+
+    def record(pipe, params, window_start, window_end, path):
+        if len(exported) == limit[0]:
+            raise KeyboardInterrupt
+        exported.append(window_start)
+        return export_window(pipe, params, window_start, window_end, path)
+
+    monkeypatch.setattr(export, "_export_window", record)
+    out = tmp_path / "resumed.parquet"
+    with pytest.raises(KeyboardInterrupt):
+        export.export(pipe, str(out), *args, concurrency=1)
+    assert not out.exists()
+
+    interrupted, limit[0] = list(exported), None
+    exported.clear()
+    export.export(pipe, str(out), *args)
+    n_windows = len(export.windows(start, END, EXPORT_WINDOW))
+    assert len(exported) == n_windows - INTERRUPT_AFTER
+    assert not set(exported) & set(interrupted)
+    assert pq.read_table(out).equals(pq.read_table(full), check_metadata=True)
+    assert out.read_bytes() == full.read_bytes()
+    assert not (tmp_path / "resumed.parquet.parts").exists()
+
+
+def test_export_memory(serve, sensors, tmp_path):
+    """Peak memory of an export doesn't grow with the length of the range."""
+    serve({})
+    label = config.TAB_CAR
+    pipe = data.TB_PIPES[label][data.TB_HIST_PIPE]
+
+    def run(timespan: str) -> tuple[int, int]:
+        out = tmp_path / f"{timespan}.parquet"
+        start = END - datetime.timedelta(days=TIMESPANS[timespan])
+        args = (pipe, str(out), start, END, sensors[label], EXPORT_WINDOW)
+        # the responses of the local Tinybird are cached by the first export
+        export.export(*args)
+        tracemalloc.start()
+        rows = export.export(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return rows, peak
+
+    month_rows, month_peak = run("Last Month")
+    year_rows, year_peak = run("Last Year")
+    assert year_rows > 10 * month_rows
+    assert year_peak < MAX_PEAK_GROWTH * month_peak
+
+
+def test_export_empty(serve, tmp_path):
+    """A range without readings fails, instead of writing no file."""
+    serve({})
+    out = tmp_path / "empty.parquet"
+    # before the synthetic data
+    start = END - datetime.timedelta(days=3 * TIMESPANS["Last Year"])
+    with pytest.raises(export.ExportError, match="no readings"):
+        export.export(
+            data.TB_PIPES[config.TAB_CAR][data.TB_HIST_PIPE],
+            str(out),
+            start,
+            start + datetime.timedelta(days=14),
+            window=EXPORT_WINDOW,
+        )
+    assert not out.exists()
+    assert not (tmp_path / "empty.parquet.parts").exists()
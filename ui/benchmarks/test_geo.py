@@ -0,0 +1,157 @@
+"""spatial queries over sensor positions (valencianow.geo), checked against a
+brute-force scan"""
+
+import math
+
+import numpy as np
+import pytest
+
+from valencianow import config, data, geo, synthetic
+
+# the grid uses an equirectangular projection, which differs from the
+# haversine distance by less than this up to ~30 km from the city center
+DISTANCE_RTOL = 2e-3
+# point queries of each benchmark, spread over the city
+N_QUERIES = 1000
+
+
+def _haversine(lat, lon, lats, lons) -> np.ndarray:
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * geo.EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def _random_points(n: int, seed: int, spread: float = 0.03):
+    rng = np.random.default_rng(seed)
+    lats = config.VALENCIA_LAT + rng.uniform(-spread, spread, n)
+    lons = config.VALENCIA_LON + rng.uniform(-spread, spread, n)
+    return lats, lons
+
+
+def _grid_points(cell_size: float, cells: int):
+    """Points lying exactly on the corners of the grid buckets."""
+    steps = np.arange(-cells, cells + 1) * cell_size
+    x, y = np.meshgrid(steps, steps)
+    lats = config.VALENCIA_LAT + np.degrees(y.ravel() / geo.EARTH_RADIUS_M)
+    lons = config.VALENCIA_LON + np.degrees(
+        x.ravel() / (geo.EARTH_RADIUS_M * geo._COS_LAT0)
+    )
+    return lats, lons
+
+
+def _positions(index: geo.SensorIndex, ids) -> tuple[np.ndarray, np.ndarray]:
+    rows = np.searchsorted(index.ids, ids)
+    return index.lats[rows], index.lons[rows]
+
+
+def _index(lats, lons, cell_size: float = geo.CELL_SIZE_M) -> geo.SensorIndex:
+    return geo.SensorIndex(np.arange(len(lats)) + 1, lats, lons, cell_size)
+
+
+# random sensors with the default grid, sensors on bucket corners, and a grid
+# much finer than the sensor spacing, so nearest has to expand many rings
+INDEXES = {
+    "random": lambda: _index(*_random_points(500, seed=1)),
+    "corners": lambda: _index(*_grid_points(geo.CELL_SIZE_M, 6)),
+    "fine-grid": lambda: _index(*_random_points(50, seed=2), cell_size=40),
+}
+QUERIES = [
+    *zip(*_random_points(50, seed=3)),
+    *zip(*_grid_points(geo.CELL_SIZE_M, 2)),
+    # far outside the area covered by the sensors
+    (config.VALENCIA_LAT + 0.2, config.VALENCIA_LON - 0.3),
+]
+
+
+@pytest.mark.parametrize("name", INDEXES)
+@pytest.mark.parametrize("meters", [50, geo.CELL_SIZE_M, 1000])
+def test_within_radius(name, meters):
+    index = INDEXES[name]()
+    for lat, lon in QUERIES:
+        found = index.within_radius(lat, lon, meters)
+        dist = _haversine(lat, lon, index.lats, index.lons)
+        surely_in = set(index.ids[dist <= meters * (1 - DISTANCE_RTOL)].tolist())
+        maybe_in = set(index.ids[dist <= meters * (1 + DISTANCE_RTOL)].tolist())
+        assert surely_in <= set(found.tolist()) <= maybe_in
+        found_dist = _haversine(lat, lon, *_positions(index, found))
+        assert np.all(np.diff(found_dist) >= -meters * DISTANCE_RTOL)
+
+
+@pytest.mark.parametrize("name", INDEXES)
+@pytest.mark.parametrize("k", [1, 5, 60])
+def test_nearest(name, k):
+    index = INDEXES[name]()
+    for lat, lon in QUERIES:
+        found = index.nearest(lat, lon, k)
+        dist = np.sort(_haversine(lat, lon, index.lats, index.lons))
+        assert len(found) == min(k, len(index))
+        ids = np.array([sensor for sensor, _ in found])
+        found_dist = _haversine(lat, lon, *_positions(index, ids))
+        np.testing.assert_allclose(found_dist, dist[: len(found)], rtol=DISTANCE_RTOL)
+        reported = [distance for _, distance in found]
+        np.testing.assert_allclose(reported, found_dist, rtol=DISTANCE_RTOL)
+
+
+@pytest.mark.parametrize("name", INDEXES)
+def test_in_bbox(name):
+    index = INDEXES[name]()
+    for lat, lon in QUERIES:
+        south, west, north, east = lat - 0.004, lon - 0.005, lat + 0.004, lon + 0.005
+        found = index.in_bbox(south, west, north, east)
+        inside = (
+            (index.lats >= south)
+            & (index.lats <= north)
+            & (index.lons >= west)
+            & (index.lons <= east)
+        )
+        assert sorted(found.tolist()) == sorted(index.ids[inside].tolist())
+
+
+def test_empty_index():
+    index = geo.SensorIndex([], [], [])
+    assert index.nearest(config.VALENCIA_LAT, config.VALENCIA_LON, 3) == []
+    assert len(index.within_radius(config.VALENCIA_LAT, config.VALENCIA_LON, 500)) == 0
+
+
+@pytest.mark.parametrize(
+    "query, street",
+    [("jativa", "Calle de Játiva"), ("Calle de Jesús", "Calle de Jesús")],
+)
+def test_locate_street(query, street):
+    lat, lon = geo.matching_streets(street)[street]
+    assert geo.locate(query) == (lat, lon)
+
+
+@pytest.mark.parametrize("query", ["a", "de", "tiva", "no such street"])
+def test_locate_no_match(query):
+    assert geo.matching_streets(query) == {}
+    assert geo.locate(query) is None
+
+
+def test_locate_several_streets():
+    assert len(geo.matching_streets("avenida")) > 1
+    assert geo.locate("avenida") is None
+
+
+@pytest.fixture(scope="module")
+def car_index():
+    """Index of the production number of car sensors."""
+    sensor_df = synthetic.sensors("cars")
+    return geo.SensorIndex(
+        sensor_df["id"], sensor_df[data.COL_LAT], sensor_df[data.COL_LON]
+    )
+
+
+@pytest.mark.parametrize("k", [1, 10])
+def test_nearest_queries(k, measure, car_index):
+    queries = list(zip(*_random_points(N_QUERIES, seed=4)))
+    measure(lambda: [car_index.nearest(lat, lon, k) for lat, lon in queries])
+
+
+def test_within_radius_queries(measure, car_index):
+    queries = list(zip(*_random_points(N_QUERIES, seed=4)))
+    measure(lambda: [car_index.within_radius(lat, lon, 300) for lat, lon in queries])
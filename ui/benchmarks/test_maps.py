@@ -0,0 +1,55 @@
+"""building and serializing the pydeck maps (valencianow.maps)"""
+
+import pytest
+from conftest import read_payload
+
+from valencianow import data, maps
+
+
+@pytest.fixture(scope="module")
+def now_data(payload):
+    """Processed *_now snapshots, by sensor type."""
+    snapshots = {}
+    for label, info in data.TB_PIPES.items():
+        raw = read_payload(payload(info[data.TB_NOW_PIPE]))
+        snapshots[label] = data._process(raw)
+    return snapshots
+
+
+def _deck_json(build):
+    return lambda: build().to_json()
+
+
+@pytest.mark.parametrize("label", [maps.LABEL_CAR, maps.LABEL_BIKE])
+def test_traffic_now_heatmap(label, measure, now_data):
+    rows, is_bike = now_data[label], label == maps.LABEL_BIKE
+    measure(
+        _deck_json(lambda: maps.traffic_now_heatmap(rows, is_bike=is_bike)),
+        payload_size=len,
+    )
+
+
+@pytest.mark.parametrize("label", [maps.LABEL_CAR, maps.LABEL_BIKE])
+def test_traffic_now_elevation(label, measure, now_data):
+    rows, is_bike = now_data[label], label == maps.LABEL_BIKE
+    measure(
+        _deck_json(lambda: maps.traffic_now_elevation(rows, is_bike=is_bike)),
+        payload_size=len,
+    )
+
+
+def test_traffic_now_elevation_in_view(measure, now_data):
+    rows = now_data[maps.LABEL_CAR]
+    view = (39.46975, -0.37739, 16)
+    measure(
+        _deck_json(lambda: maps.traffic_now_elevation(rows, view=view)),
+        payload_size=len,
+    )
+
+
+def test_air_now_scatterplot(measure, now_data):
+    rows = now_data[maps.LABEL_AIR]
+    measure(
+        _deck_json(lambda: maps.air_now_scatterplot(rows.copy())),
+        payload_size=len,
+    )
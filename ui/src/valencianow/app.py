@@ -1,22 +1,78 @@
 import pandas as pd
 import streamlit as st
 
-from valencianow import components, config, data, maps
+from valencianow import components, config, data, geo, maps, metrics
+
+# upper bound of sensors fetched in a single comparison request
+MAX_COMPARED_SENSORS = 20
+# radius used to find the sensors around a searched location
+NEAR_RADIUS_M = 300
+# zoom level of the maps when they are centered on a searched location
+FOCUS_ZOOM = 15
+# streets listed when a searched location matches several of them
+MAX_LISTED_STREETS = 5
+
+
+def searched_location(label: str) -> tuple[float, float] | None:
+    """Location typed in the nearest-sensor search box of the given tab."""
+    query = st.session_state.get(f"near-{label}")
+    return geo.locate(query) if query else None
+
+
+def focus_view(label: str) -> maps.View | None:
+    location = searched_location(label)
+    return (*location, FOCUS_ZOOM) if location else None
+
+
+def location_not_found(query: str) -> str:
+    """Explain why a searched location couldn't be resolved."""
+    if len(query.strip()) < geo.MIN_QUERY_LENGTH:
+        return f"Type at least {geo.MIN_QUERY_LENGTH} characters of a street name"
+    streets = list(geo.matching_streets(query))
+    if len(streets) > 1:
+        shown = ", ".join(streets[:MAX_LISTED_STREETS])
+        more = "..." if len(streets) > MAX_LISTED_STREETS else ""
+        return f"{len(streets)} streets match, be more specific: {shown}{more}"
+    return "Location not found, try with another address"
+
+
+def nearest_sensor(data_now: pd.DataFrame, label: str) -> int | None:
+    st.text_input(
+        "📍 Find the nearest sensor to an address or a `lat, lon` location",
+        key=f"near-{label}",
+    )
+    if not st.session_state.get(f"near-{label}"):
+        return None
+    location = searched_location(label)
+    if location is None:
+        st.warning(location_not_found(st.session_state[f"near-{label}"]))
+        return None
+    index = geo.sensor_index(label, data_now)
+    for sensor, distance in index.nearest(*location, k=10):
+        # the index also contains sensors that have no data right now
+        if (data_now[data.COL_SENSOR] == sensor).any():
+            name = data.get_sensor_display_name(sensor, label)
+            st.caption(f"Nearest sensor: **{name}** ({distance:.0f} m away)")
+            return sensor
+    return None
 
 
 def aggregated_sensor_data(data_now: pd.DataFrame, label: str) -> None:
     info = data.TB_PIPES[label]
     sensor_param = info[data.TB_SENSOR_PARAM]
     st.markdown("## ➕ Individual sensor data")
+    nearest = nearest_sensor(data_now, label)
     with st.form(f"aggregated-sensor-{label}"):
         sensor_ids = sorted(data_now[data.COL_SENSOR].unique())
         sensor_options = {
             data.get_sensor_display_name(int(sid), label): int(sid)
             for sid in sensor_ids
         }
+        sensor_values = list(sensor_options.values())
         sensor_display = st.selectbox(
             "🔢 Select a sensor to show its data",
             options=list(sensor_options.keys()),
+            index=sensor_values.index(nearest) if nearest in sensor_values else 0,
         )
         sensor = sensor_options[sensor_display]
         timespan = st.radio(
@@ -57,6 +113,102 @@ def aggregated_sensor_data(data_now: pd.DataFrame, label: str) -> None:
                         )
 
 
+def compare_sensors_data(data_now: pd.DataFrame, label: str) -> None:
+    info = data.TB_PIPES[label]
+    st.markdown("## 🔀 Compare sensors")
+    presets = {}
+    location = searched_location(label)
+    if location is not None:
+        index = geo.sensor_index(label, data_now)
+        available = set(data_now[data.COL_SENSOR].astype(int))
+        presets[f"📍 Within {NEAR_RADIUS_M} m of the searched location"] = [
+            int(sid)
+            for sid in index.within_radius(*location, NEAR_RADIUS_M)
+            if sid in available
+        ]
+    presets.update(data.sensors_by_street(data_now[data.COL_SENSOR].unique(), label))
+    preset = st.selectbox(
+        "🛣️ Preselect the sensors of a street or around the searched location",
+        options=[""] + list(presets.keys()),
+        key=f"compare-street-{label}",
+    )
+    with st.form(f"compare-sensors-{label}"):
+        sensor_ids = sorted(int(sid) for sid in data_now[data.COL_SENSOR].unique())
+        sensor_names = {
+            sid: data.get_sensor_display_name(sid, label) for sid in sensor_ids
+        }
+        sensors = st.multiselect(
+            "🔢 Select the sensors to compare",
+            options=sensor_ids,
+            default=presets.get(preset, [])[:MAX_COMPARED_SENSORS],
+            format_func=lambda sid: sensor_names[sid],
+            max_selections=MAX_COMPARED_SENSORS,
+        )
+        timespan = st.radio(
+            "Select a time span: ",
+            ["Today", "Last Week", "Last Month", "Last Year"],
+            index=1,
+            horizontal=True,
+        )
+        if st.form_submit_button("🔎 Compare sensor data", width="stretch"):
+            if not sensors:
+                st.error("Select at least one sensor")
+            else:
+                components.comparison_graph(
+                    info[data.TB_HIST_PIPE],
+                    timespan,
+                    sensors,
+                    label,
+                    info[data.TB_HIST_MEAS],
+                    info[data.TB_HIST_Y],
+                    sensors_param=info[data.TB_SENSORS_PARAM],
+                )
+
+
+def pollutant_data(data_now: pd.DataFrame) -> None:
+    info = data.TB_PIPES[maps.LABEL_AIR]
+    st.markdown("## 🧪 Pollutants")
+    with st.form("pollutants"):
+        pollutant = st.radio(
+            "Select a pollutant: ",
+            list(data.POLLUTANTS),
+            format_func=lambda name: data.POLLUTANTS[name],
+            horizontal=True,
+        )
+        sensor_ids = sorted(int(sid) for sid in data_now[data.COL_SENSOR].unique())
+        sensor = st.selectbox(
+            "🔢 Select a station, or the whole city",
+            options=[None, *sensor_ids],
+            format_func=lambda sid: (
+                "🏙️ Whole city (mean of the stations)"
+                if sid is None
+                else data.get_sensor_display_name(sid, maps.LABEL_AIR)
+            ),
+        )
+        timespan = st.radio(
+            "Select a time span for the pollutant: ",
+            ["Today", "Last Week", "Last Month", "Last Year"],
+            index=1,
+            horizontal=True,
+        )
+        if st.form_submit_button("🔎 Show pollutant data", width="stretch"):
+            components.pollutant_history_graph(
+                info[data.TB_POLLUTANT_HIST_PIPE],
+                timespan,
+                sensor,
+                pollutant,
+                sensor_param=info[data.TB_SENSOR_PARAM],
+            )
+            if timespan != "Today":
+                components.pollutant_per_day_graph(
+                    info[data.TB_POLLUTANT_PER_DAY_PIPE],
+                    timespan,
+                    sensor,
+                    pollutant,
+                    sensor_param=info[data.TB_SENSOR_PARAM],
+                )
+
+
 def render_tab_car(tab) -> None:
     with tab:
         st.markdown(
@@ -68,7 +220,7 @@ def render_tab_car(tab) -> None:
         )
         car_date_info, car_date_reset = st.empty(), st.empty()
         car_selected_date = components.date_selector(1)
-        traffic_data = data.load_data("cars_now", car_selected_date)
+        traffic_data = data.load_now("cars_now", car_selected_date)
         car_selected_date = components.reset_date_filter(
             car_selected_date, car_date_reset
         )
@@ -82,13 +234,24 @@ def render_tab_car(tab) -> None:
             # Load balizas data only when viewing current data (no date filter)
             balizas_data = None
             if car_selected_date is None:
-                balizas_data = data.load_balizas_data()
+                balizas_data = data.load_balizas_snapshot()
+            kpis = data.load_kpis(maps.LABEL_CAR, car_selected_date)
+            if kpis is not None:
+                components.kpi_strip(kpis, maps.LABEL_CAR)
+            view = focus_view(maps.LABEL_CAR)
             car_maps_col_1, car_maps_col_2 = st.columns(2)
             with car_maps_col_1:
-                st.pydeck_chart(maps.traffic_now_heatmap(traffic_data, balizas_data))
+                components.map_chart(
+                    maps.traffic_now_heatmap(traffic_data, balizas_data, view=view),
+                    "cars_heatmap",
+                )
             with car_maps_col_2:
-                st.pydeck_chart(maps.traffic_now_elevation(traffic_data))
+                components.map_chart(
+                    maps.traffic_now_elevation(traffic_data, view=view),
+                    "cars_elevation",
+                )
             aggregated_sensor_data(traffic_data, maps.LABEL_CAR)
+            compare_sensors_data(traffic_data, maps.LABEL_CAR)
 
 
 def render_tab_bike(tab) -> None:
@@ -101,7 +264,7 @@ def render_tab_bike(tab) -> None:
         )
         bike_date_info, bike_reset = st.empty(), st.empty()
         bike_date = components.date_selector(2)
-        traffic_bike_data = data.load_data("bikes_now", bike_date)
+        traffic_bike_data = data.load_now("bikes_now", bike_date)
         bike_date = components.reset_date_filter(bike_date, bike_reset)
         if traffic_bike_data is None:
             st.error("No data found for selected date and time")
@@ -109,16 +272,27 @@ def render_tab_bike(tab) -> None:
             max_date = traffic_bike_data[data.COL_DATE].max()
             bike_date_info.markdown(f""" \n 📅⠀Max date currently visualized: `{max_date}`
             (updated every 30 min)""")
+            kpis = data.load_kpis(maps.LABEL_BIKE, bike_date)
+            if kpis is not None:
+                components.kpi_strip(kpis, maps.LABEL_BIKE)
+            view = focus_view(maps.LABEL_BIKE)
             bike_maps_col_1, bikes_maps_col_2 = st.columns(2)
             with bike_maps_col_1:
-                st.pydeck_chart(
-                    maps.traffic_now_heatmap(traffic_bike_data, is_bike=True)
+                components.map_chart(
+                    maps.traffic_now_heatmap(
+                        traffic_bike_data, is_bike=True, view=view
+                    ),
+                    "bikes_heatmap",
                 )
             with bikes_maps_col_2:
-                st.pydeck_chart(
-                    maps.traffic_now_elevation(traffic_bike_data, is_bike=True)
+                components.map_chart(
+                    maps.traffic_now_elevation(
+                        traffic_bike_data, is_bike=True, view=view
+                    ),
+                    "bikes_elevation",
                 )
             aggregated_sensor_data(traffic_bike_data, maps.LABEL_BIKE)
+            compare_sensors_data(traffic_bike_data, maps.LABEL_BIKE)
 
 
 def render_tab_air(tab) -> None:
@@ -135,7 +309,7 @@ def render_tab_air(tab) -> None:
         )
         air_date_info, air_date_reset = st.empty(), st.empty()
         air_date = components.date_selector(3)
-        air_quality_data = data.load_data("air_now", air_date)
+        air_quality_data = data.load_now("air_now", air_date)
         air_date = components.reset_date_filter(air_date, air_date_reset)
         if air_quality_data is None:
             st.error("No data found for selected date and time")
@@ -143,11 +317,20 @@ def render_tab_air(tab) -> None:
             max_date = air_quality_data[data.COL_DATE].max()
             air_date_info.markdown(f"""\n 📅⠀Max date currently visualized: `{max_date}`
             (updated every hour)""")
-            st.pydeck_chart(maps.air_now_scatterplot(air_quality_data))
-        aggregated_sensor_data(air_quality_data, maps.LABEL_AIR)
+            components.map_chart(
+                maps.air_now_scatterplot(
+                    air_quality_data, view=focus_view(maps.LABEL_AIR)
+                ),
+                "air_scatterplot",
+            )
+            aggregated_sensor_data(air_quality_data, maps.LABEL_AIR)
+            compare_sensors_data(air_quality_data, maps.LABEL_AIR)
+            pollutant_data(air_quality_data)
 
 
 def main() -> None:
+    config.validate()
+    metrics.start_server()
     tab_car, tab_bike, tab_air = components.header()
     render_tab_car(tab_car)
     render_tab_bike(tab_bike)
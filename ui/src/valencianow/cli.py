@@ -0,0 +1,27 @@
+"""command line entry point.
+
+valencianow [ui] [streamlit options]   start the application (default)
+valencianow export ...                 export history to Parquet
+"""
+
+import sys
+
+
+def main() -> None:
+    command, *args = sys.argv[1:] or ["ui"]
+    if command == "export":
+        from valencianow import export
+
+        export.main(args)
+        return
+    # the launcher imports streamlit, which the export doesn't need
+    from valencianow import launcher
+
+    if command != "ui":
+        args = [command, *args]
+    sys.argv = [sys.argv[0], *args]
+    launcher.main()
+
+
+if __name__ == "__main__":
+    main()
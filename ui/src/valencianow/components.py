@@ -1,10 +1,21 @@
-import plotly.express as px
+from typing import TYPE_CHECKING
+
+import pandas as pd
 import streamlit as st
 
-from valencianow import config, data
+from valencianow import config, data, metrics
+
+if TYPE_CHECKING:
+    # plotly and pydeck are imported where they are used, to keep the
+    # application start fast
+    import plotly.graph_objects as go
+    import pydeck as pdk
 
 logger = config.logger
 
+# name of the line of the pollutant chart averaging all the stations
+CITY_MEAN = "city mean"
+
 
 def header():
     st.set_page_config(page_title=config.APP_NAME, page_icon="🦇", layout="wide")
@@ -51,6 +62,177 @@ def reset_date_filter(date: str | None, reset) -> str | None:
     return date
 
 
+def _week_delta(value: float, week_ago: float) -> str | None:
+    if pd.isna(week_ago) or week_ago == 0:
+        return None
+    return f"{(value - week_ago) / week_ago:+.1%} vs last week"
+
+
+def kpi_strip(kpis: pd.DataFrame, label: str) -> None:
+    """Summary of the whole city: one row per busiest sensor, all of them
+    with the KPIs of the latest interval (see data.load_kpis)."""
+    latest = kpis.iloc[0]
+    unit = f"{label}s/hour"
+    col_1, col_2, col_3, col_4 = st.columns(4)
+    col_1.metric(
+        f"🏙️ City total ({unit})",
+        f"{latest['total_ih']:,.0f}",
+        _week_delta(latest["total_ih"], latest["week_ago_total_ih"]),
+        help="Sum of all the sensors, compared with the same time a week ago",
+    )
+    col_2.metric(
+        f"📅 Today's average ({unit})",
+        f"{latest['day_avg_ih']:,.0f}",
+        _week_delta(latest["day_avg_ih"], latest["week_ago_day_avg_ih"]),
+        help="Average city total since midnight, compared with the same hours "
+        "of the same weekday last week",
+    )
+    col_3.metric("🔢 Reporting sensors", f"{latest['sensors']:,.0f}")
+    col_4.metric(
+        f"🔥 Busiest sensor ({unit})",
+        f"{latest['ih']:,.0f}",
+        help=data.get_sensor_display_name(int(latest[data.COL_SENSOR]), label),
+    )
+    busiest = ", ".join(
+        f"{data.get_sensor_display_name(int(row[data.COL_SENSOR]), label)} "
+        f"(`{row['ih']:,.0f}`)"
+        for _, row in kpis.iterrows()
+    )
+    st.caption(f"🔥 Busiest sensors at {latest[data.COL_DATE]}: {busiest}")
+
+
+def map_chart(deck: "pdk.Deck", target: str) -> None:
+    """Show a map, timing its serialization to the browser."""
+    with metrics.span("render", target=target):
+        st.pydeck_chart(deck)
+
+
+def plotly_chart(fig: "go.Figure", target: str) -> None:
+    """Show a chart, timing its serialization to the browser."""
+    with metrics.span("render", target=target):
+        st.plotly_chart(fig, theme="streamlit", width="stretch")
+
+
+@metrics.timed("build")
+def historical_figure(data_sensor: pd.DataFrame, y_axis: str) -> "go.Figure":
+    import plotly.express as px
+
+    data_sensor = data_sensor.sort_values(by=data.COL_DATETIME)
+    return px.line(
+        data_sensor,
+        x=data.COL_DATETIME,
+        y=y_axis,
+        markers=True,
+        line_shape="spline",
+    )
+
+
+@metrics.timed("build")
+def comparison_figure(
+    data_sensors: pd.DataFrame, label: str, y_axis: str
+) -> "go.Figure":
+    import plotly.express as px
+
+    aligned = data.align_sensor_series(data_sensors, y_axis)
+    aligned.columns = [
+        data.get_sensor_display_name(int(sid), label) for sid in aligned.columns
+    ]
+    fig = px.line(aligned, labels={"value": y_axis, "variable": "sensor"})
+    fig.update_layout(legend={"orientation": "h", "yanchor": "top", "y": -0.2})
+    return fig
+
+
+@metrics.timed("build")
+def per_day_figure(data_agg_sensor: pd.DataFrame, y_axis: str) -> "go.Figure":
+    import plotly.express as px
+
+    fig = px.bar(
+        data_agg_sensor,
+        x=data.COL_DAY,
+        y=y_axis,
+        hover_data={data.COL_DAY: "|%A - %B %d, %Y"},
+    )
+    fig.update_xaxes(tickformat="%a - %b %d")
+    return fig
+
+
+@metrics.timed("build")
+def per_day_of_week_figure(
+    data_agg_week_sensor: pd.DataFrame, y_axis: str
+) -> "go.Figure":
+    import plotly.express as px
+
+    day_name_map = {
+        1: "Monday",
+        2: "Tuesday",
+        3: "Wednesday",
+        4: "Thursday",
+        5: "Friday",
+        6: "Saturday",
+        7: "Sunday",
+    }
+    data_agg_week_sensor["day_of_week"] = data_agg_week_sensor["day_of_week"].map(
+        day_name_map
+    )
+    return px.bar(data_agg_week_sensor, x="day_of_week", y=y_axis)
+
+
+@metrics.timed("build")
+def pollutant_history_figure(
+    data_pollutant: pd.DataFrame, pollutant: str
+) -> "go.Figure":
+    import plotly.express as px
+
+    data_pollutant = data_pollutant.sort_values(by=data.COL_DATETIME)
+    stations = data_pollutant[data.COL_SENSOR].map(
+        lambda sid: data.get_sensor_display_name(int(sid), config.TAB_AIR)
+    )
+    fig = px.line(
+        data_pollutant,
+        x=data.COL_DATETIME,
+        y="value",
+        color=stations,
+        hover_data={"max_value": True},
+        labels={"value": data.POLLUTANTS[pollutant], "color": "station"},
+    )
+    fig.update_layout(legend={"orientation": "h", "yanchor": "top", "y": -0.2})
+    if data_pollutant[data.COL_SENSOR].nunique() > 1:
+        # the whole city: mean of the stations over their faint lines, each
+        # station weighs the same whatever its number of readings
+        city = data_pollutant.groupby(data.COL_DATETIME, as_index=False).agg(
+            value=("value", "mean"), max_value=("max_value", "max")
+        )
+        fig.update_traces(opacity=0.3, line={"width": 1})
+        fig.add_scatter(
+            x=city[data.COL_DATETIME],
+            y=city["value"],
+            customdata=city[["max_value"]],
+            mode="lines",
+            name=CITY_MEAN,
+            line={"width": 3, "color": "black"},
+            hovertemplate="city mean: %{y:.1f}<br>highest station: "
+            "%{customdata[0]:.1f}<extra></extra>",
+        )
+    return fig
+
+
+@metrics.timed("build")
+def pollutant_per_day_figure(
+    data_pollutant: pd.DataFrame, pollutant: str
+) -> "go.Figure":
+    import plotly.express as px
+
+    fig = px.bar(
+        data_pollutant,
+        x=data.COL_DAY,
+        y="max_value",
+        hover_data={data.COL_DAY: "|%A - %B %d, %Y", "avg_value": ":.1f"},
+        labels={"max_value": f"daily max {data.POLLUTANTS[pollutant]}"},
+    )
+    fig.update_xaxes(tickformat="%a - %b %d")
+    return fig
+
+
 def historical_graph(
     pipe: str,
     timespan: str,
@@ -64,15 +246,32 @@ def historical_graph(
     )
     if data_sensor is not None:
         st.markdown(f"#### Historical data: {measurement} ({timespan})")
-        data_sensor = data_sensor.sort_values(by=data.COL_DATETIME)
-        fig = px.line(
-            data_sensor,
-            x=data.COL_DATETIME,
-            y=y_axis,
-            markers=True,
-            line_shape="spline",
-        )
-        st.plotly_chart(fig, theme="streamlit", width="stretch")
+        fig = historical_figure(data_sensor, y_axis)
+        plotly_chart(fig, "historical")
+
+
+def comparison_graph(
+    pipe: str,
+    timespan: str,
+    sensors: list[int],
+    label: str,
+    measurement: str,
+    y_axis: str,
+    sensors_param: str = "idpms",
+) -> None:
+    data_sensors = data.load_data(
+        pipe,
+        None,
+        filter_sensors=sensors,
+        filter_timespan=timespan,
+        sensors_param=sensors_param,
+    )
+    if data_sensors is None:
+        st.error("No data found for the selected sensors")
+        return
+    st.markdown(f"#### Compared data: {measurement} ({timespan})")
+    fig = comparison_figure(data_sensors, label, y_axis)
+    plotly_chart(fig, "comparison")
 
 
 def per_day_graph(
@@ -82,14 +281,8 @@ def per_day_graph(
     data_agg_sensor = data.load_data(
         pipe, None, sensor, filter_timespan=timespan, sensor_param=sensor_param
     )
-    fig = px.bar(
-        data_agg_sensor,
-        x=data.COL_DAY,
-        y=y_axis,
-        hover_data={data.COL_DAY: "|%A - %B %d, %Y"},
-    )
-    fig.update_xaxes(tickformat="%a - %b %d")
-    st.plotly_chart(fig, theme="streamlit", width="stretch")
+    fig = per_day_figure(data_agg_sensor, y_axis)
+    plotly_chart(fig, "per_day")
 
 
 def per_day_of_week_graph(
@@ -99,17 +292,50 @@ def per_day_of_week_graph(
     data_agg_week_sensor = data.load_data(
         pipe, None, sensor, filter_timespan=timespan, sensor_param=sensor_param
     )
-    day_name_map = {
-        1: "Monday",
-        2: "Tuesday",
-        3: "Wednesday",
-        4: "Thursday",
-        5: "Friday",
-        6: "Saturday",
-        7: "Sunday",
-    }
-    data_agg_week_sensor["day_of_week"] = data_agg_week_sensor["day_of_week"].map(
-        day_name_map
+    fig = per_day_of_week_figure(data_agg_week_sensor, y_axis)
+    plotly_chart(fig, "per_day_of_week")
+
+
+def pollutant_history_graph(
+    pipe: str,
+    timespan: str,
+    sensor: int | None,
+    pollutant: str,
+    sensor_param: str = "_objectid",
+) -> None:
+    data_pollutant = data.load_data(
+        pipe,
+        None,
+        sensor,
+        filter_timespan=timespan,
+        sensor_param=sensor_param,
+        pollutant=pollutant,
+    )
+    if data_pollutant is None:
+        st.error("No data found for the selected pollutant")
+        return
+    st.markdown(f"#### Hourly average: {data.POLLUTANTS[pollutant]} ({timespan})")
+    fig = pollutant_history_figure(data_pollutant, pollutant)
+    plotly_chart(fig, "pollutant_history")
+
+
+def pollutant_per_day_graph(
+    pipe: str,
+    timespan: str,
+    sensor: int | None,
+    pollutant: str,
+    sensor_param: str = "_objectid",
+) -> None:
+    data_pollutant = data.load_data(
+        pipe,
+        None,
+        sensor,
+        filter_timespan=timespan,
+        sensor_param=sensor_param,
+        pollutant=pollutant,
     )
-    fig = px.bar(data_agg_week_sensor, x="day_of_week", y=y_axis)
-    st.plotly_chart(fig, theme="streamlit", width="stretch")
+    if data_pollutant is None:
+        return
+    st.markdown(f"**📅 Daily maximum: {data.POLLUTANTS[pollutant]}**")
+    fig = pollutant_per_day_figure(data_pollutant, pollutant)
+    plotly_chart(fig, "pollutant_per_day")
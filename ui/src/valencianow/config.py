@@ -6,8 +6,10 @@ TAB_CAR, TAB_BIKE, TAB_AIR = "car", "bike", "air"
 
 VALENCIA_LAT, VALENCIA_LON = 39.46975, -0.37739
 
-TINYBIRD_API = os.environ["TINYBIRD_HOST"]
-TINYBIRD_TOKEN = os.environ["TINYBIRD_TOKEN"]
+# required, checked by validate() when the application starts
+TINYBIRD_API = os.environ.get("TINYBIRD_HOST", "")
+TINYBIRD_TOKEN = os.environ.get("TINYBIRD_TOKEN", "")
+REQUIRED_ENV_VARS = ("TINYBIRD_HOST", "TINYBIRD_TOKEN")
 
 # urls of the original data sources
 OPENDATA_VAL = "https://opendata.vlci.valencia.es/dataset"
@@ -21,3 +23,10 @@ logger_handler = logging.StreamHandler()
 formatter = logging.Formatter("%(asctime)s %(levelname)-8s [%(module)s] %(message)s")
 logger_handler.setFormatter(formatter)
 logger.addHandler(logger_handler)
+
+
+def validate() -> None:
+    """Fail early if the required environment variables are missing."""
+    missing = [name for name in REQUIRED_ENV_VARS if not os.environ.get(name)]
+    if missing:
+        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
@@ -1,15 +1,21 @@
 import base64
 import datetime
+import io
 import json
+import logging
 import os
+import threading
+import time
 import urllib.parse
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
+import numpy as np
 import pandas as pd
 import pytz
 import requests
 
-from valencianow import config
+from valencianow import config, metrics, sharedcache
 
 logger = config.logger
 
@@ -22,8 +28,12 @@ TB_PER_DAY_Y = "per_day_y"
 TB_PER_DOW_PIPE = "per_dow_pipe"
 TB_PER_DOW_Y = "per_dow_y"
 TB_SENSOR_PARAM = "sensor_param"
+TB_SENSORS_PARAM = "sensors_param"
 TB_SENSOR_COL = "sensor_col"
 TB_DATETIME_COL = "datetime_col"
+TB_POLLUTANT_HIST_PIPE = "pollutant_hist_pipe"
+TB_POLLUTANT_PER_DAY_PIPE = "pollutant_per_day_pipe"
+TB_KPIS_PIPE = "kpis_pipe"
 
 COL_DATETIME = "datetime"
 COL_DATE = "date"
@@ -32,6 +42,16 @@ COL_LON = "lon"
 COL_DAY = "day"
 COL_SENSOR = "sensor"
 
+# seconds to wait for a Tinybird response
+TB_TIMEOUT = 30
+# seconds the latest snapshots (*_now pipes without a date filter, and the
+# balizas) are shared by all the sessions before being requested again
+SNAPSHOT_TTL = 300
+
+# all datasources are appended every 30 minutes, so readings of different sensors
+# are aligned to this frequency before being compared
+ALIGN_FREQ = "30min"
+
 # the names of the Tinybird pipes
 TB_PIPES = {
     config.TAB_AIR: {
@@ -44,8 +64,11 @@ TB_PIPES = {
         TB_PER_DOW_PIPE: "air_per_day_of_week",
         TB_PER_DOW_Y: "avg_ica",
         TB_SENSOR_PARAM: "_objectid",
+        TB_SENSORS_PARAM: "_objectids",
         TB_SENSOR_COL: "_objectid",
         TB_DATETIME_COL: "fecha_carga",
+        TB_POLLUTANT_HIST_PIPE: "air_pollutant_history",
+        TB_POLLUTANT_PER_DAY_PIPE: "air_pollutant_per_day",
     },
     config.TAB_CAR: {
         TB_NOW_PIPE: "cars_now",
@@ -57,8 +80,10 @@ TB_PIPES = {
         TB_PER_DOW_PIPE: "cars_per_day_of_week",
         TB_PER_DOW_Y: "avg_ih",
         TB_SENSOR_PARAM: "idpm",
+        TB_SENSORS_PARAM: "idpms",
         TB_SENSOR_COL: "idpm",
         TB_DATETIME_COL: "last_edited_date",
+        TB_KPIS_PIPE: "cars_kpis",
     },
     config.TAB_BIKE: {
         TB_NOW_PIPE: "bikes_now",
@@ -70,11 +95,33 @@ TB_PIPES = {
         TB_PER_DOW_PIPE: "bikes_per_day_of_week",
         TB_PER_DOW_Y: "avg_ih",
         TB_SENSOR_PARAM: "idpm",
+        TB_SENSORS_PARAM: "idpms",
         TB_SENSOR_COL: "idpm",
         TB_DATETIME_COL: "last_edited_date",
+        TB_KPIS_PIPE: "bikes_kpis",
     },
 }
 
+# pollutants measured by the air quality stations (the `pollutant` parameter
+# of the air_pollutant_* pipes), with their units
+POLLUTANTS = {
+    "no2": "NO₂ (µg/m³)",
+    "o3": "O₃ (µg/m³)",
+    "pm10": "PM10 (µg/m³)",
+    "pm25": "PM2.5 (µg/m³)",
+    "so2": "SO₂ (µg/m³)",
+    "co": "CO (mg/m³)",
+}
+
+
+# pipes that accept lean=true, mapped to their sensor type. In lean mode they
+# don't return geo_point_2d, sensor positions are joined from the static table
+LEAN_PIPES = {
+    info[pipe]: label
+    for label, info in TB_PIPES.items()
+    for pipe in (TB_NOW_PIPE, TB_HIST_PIPE)
+}
+
 
 def _process(df: pd.DataFrame) -> pd.DataFrame | None:
     if df.shape[0] > 0:
@@ -161,12 +208,22 @@ def load_data(
     filter_timespan: str | None = None,
     local_time: bool = False,
     sensor_param: str = "idpm",  # parameter name for sensor filter
+    filter_sensors: list[int] | None = None,
+    sensors_param: str = "idpms",  # parameter name for multi-sensor filter
+    pollutant: str | None = None,  # for the air_pollutant_* pipes
 ) -> pd.DataFrame | None:
     """Load data from the given Tinybird pipe name.
 
     Some optional filters can be provided.
     A None value can be returned if there are no rows.
 
+    filter_sensors retrieves the data of several sensors in a single request
+    (supported by the *_now and *_history pipes). Those pipes are always
+    queried in lean mode, sensor positions are attached afterwards.
+
+    With a shared cache (see valencianow.sharedcache), the results of the
+    last filter_timespan are shared by all the workers.
+
     local_time=False (default): filter_max_date is treated as Spain local time
     and converted to UTC before querying. All datasources store UTC, so this
     should always be False.
@@ -184,11 +241,202 @@ def load_data(
         params["min_date"] = _min_date(max_date, filter_timespan)
     if filter_sensor:
         params[sensor_param] = filter_sensor
+    if filter_sensors:
+        params[sensors_param] = ",".join(str(int(sid)) for sid in filter_sensors)
+    if pollutant:
+        params["pollutant"] = pollutant
+    if pipe_name in LEAN_PIPES:
+        params["lean"] = "true"
+    if filter_timespan and not filter_max_date and sharedcache.enabled():
+        # results of the last timespan are shared by the workers for
+        # SNAPSHOT_TTL, keyed without min_date (it changes on every call)
+        shared = {k: v for k, v in params.items() if k != "min_date"}
+        key = f"{pipe_name}|{filter_timespan}|{urllib.parse.urlencode(shared)}"
+        return sharedcache.get(key, partial(_load, pipe_name, params), SNAPSHOT_TTL)
+    return _load(pipe_name, params)
+
+
+def _load(pipe_name: str, params: dict) -> pd.DataFrame | None:
+    with metrics.span("load", logging.INFO, pipe=pipe_name) as load:
+        raw = _query_mirror(pipe_name, params)
+        load["source"] = "tinybird" if raw is None else "mirror"
+        if raw is None:
+            raw = _fetch(pipe_name, params)
+        with metrics.span("normalize", pipe=pipe_name):
+            df = _process(raw)
+            if df is not None and pipe_name in LEAN_PIPES:
+                df = _attach_locations(df, LEAN_PIPES[pipe_name], params)
+        load["rows"] = len(raw)
+    return df
+
+
+def _query_mirror(pipe_name: str, params: dict) -> pd.DataFrame | None:
+    """Response of a history pipe from the local mirror, if it covers it."""
+    # imported here, the mirror uses this module
+    from valencianow import mirror
+
+    return mirror.query(pipe_name, params) if mirror.enabled() else None
+
+
+_snapshots: dict[str, tuple[float, pd.DataFrame | None]] = {}
+_snapshot_locks: dict[str, threading.Lock] = {}
+_snapshot_locks_lock = threading.Lock()
+
+
+def _snapshot(key: str, load) -> pd.DataFrame | None:
+    """Latest data shared by all the sessions, loaded at most once per
+    SNAPSHOT_TTL. Concurrent requests of an expired snapshot wait for a single
+    load. The returned dataframe is shared, so it must not be modified.
+
+    With a shared cache (see valencianow.sharedcache), snapshots are kept
+    there instead, and loaded by a single worker."""
+    if sharedcache.enabled():
+        return sharedcache.get(key, load, SNAPSHOT_TTL)
+    with _snapshot_locks_lock:
+        lock = _snapshot_locks.setdefault(key, threading.Lock())
+    with lock:
+        cached = _snapshots.get(key)
+        if cached is not None and time.monotonic() - cached[0] < SNAPSHOT_TTL:
+            metrics.inc(metrics.CACHE_REQUESTS, pipe=key, result="hit")
+            return cached[1]
+        metrics.inc(metrics.CACHE_REQUESTS, pipe=key, result="miss")
+        df = load()
+        _snapshots[key] = (time.monotonic(), df)
+        return df
+
+
+def load_now(pipe_name: str, filter_max_date: str | None) -> pd.DataFrame | None:
+    """Load the data of a *_now pipe.
+
+    Without a date filter, the latest snapshot is shared by all the sessions.
+    """
+    if filter_max_date:
+        return load_data(pipe_name, filter_max_date)
+    return _snapshot(pipe_name, partial(load_data, pipe_name, None))
+
+
+def load_kpis(sensor_type: str, filter_max_date: str | None) -> pd.DataFrame | None:
+    """Load the city-wide KPIs of a traffic sensor type (see the *_kpis pipes).
+
+    All the rows share the KPIs of the latest interval, there is one of them
+    for each of its busiest sensors. Without a date filter, they are shared
+    by all the sessions, like the *_now snapshots.
+    """
+    return load_now(TB_PIPES[sensor_type][TB_KPIS_PIPE], filter_max_date)
+
+
+def prewarm() -> None:
+    """Load all the snapshots in parallel, so that the first visitor after a
+    start doesn't wait for them."""
+    pipes = [
+        info[pipe]
+        for info in TB_PIPES.values()
+        for pipe in (TB_NOW_PIPE, TB_KPIS_PIPE)
+        if pipe in info
+    ]
+    with ThreadPoolExecutor(max_workers=len(pipes) + 1) as pool:
+        futures = {pipe: pool.submit(load_now, pipe, None) for pipe in pipes}
+        futures[BALIZAS_SOURCE] = pool.submit(load_balizas_snapshot)
+    for name, future in futures.items():
+        try:
+            future.result()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning(f"Could not prewarm {name}: {e}")
+
+
+def _fetch(pipe_name: str, params: dict) -> pd.DataFrame:
     logger.info(f"Retrieving {pipe_name} data from Tinybird with params: {params}")
-    params["token"] = config.TINYBIRD_TOKEN
+    params = {**params, "token": config.TINYBIRD_TOKEN}
     url = f"{config.TINYBIRD_API}/v0/pipes/{pipe_name}.csv?{urllib.parse.urlencode(params)}"
     logger.info(f"Retrieving from Tinybird url {url}")
-    return _process(pd.read_csv(url))
+    with metrics.span("network", pipe=pipe_name):
+        response = requests.get(url, timeout=TB_TIMEOUT)
+        response.raise_for_status()
+    metrics.inc(metrics.RECEIVED_BYTES, len(response.content), pipe=pipe_name)
+    with metrics.span("parse", pipe=pipe_name):
+        # ClickHouse writes NULL values as \N in CSV responses
+        df = pd.read_csv(io.BytesIO(response.content), na_values=["\\N"])
+    metrics.inc(metrics.ROWS, len(df), pipe=pipe_name)
+    return df
+
+
+def _attach_locations(df: pd.DataFrame, sensor_type: str, params: dict) -> pd.DataFrame:
+    """Add lat and lon columns to a lean response.
+
+    Positions are joined from the known sensor locations (see
+    known_locations). Sensors not found there fall back to the coordinates
+    returned by the *_now endpoint, requested (for those sensors only) with
+    geo_point_2d included, and kept for the next responses.
+    """
+    sensors = df[COL_SENSOR].to_numpy(dtype=np.int64)
+    known = _join_locations(df, sensors, *known_locations(sensor_type))
+    if not known.all():
+        with _fetched_locations_lock:
+            # another session may have fetched them while waiting for the lock
+            ids, lats, lons = known_locations(sensor_type)
+            unknown = np.setdiff1d(sensors[~known], ids)
+            if len(unknown) > 0:
+                ids, lats, lons = _fetch_locations(
+                    sensor_type, unknown, params.get("max_date")
+                )
+        _join_locations(df, sensors, ids, lats, lons)
+    return df
+
+
+def _join_locations(
+    df: pd.DataFrame,
+    sensors: np.ndarray,
+    ids: np.ndarray,
+    lats: np.ndarray,
+    lons: np.ndarray,
+) -> np.ndarray:
+    """Set the lat and lon columns of df from positions sorted by sensor id.
+
+    Returns which rows have their sensor among the given ids.
+    """
+    if len(ids) == 0:
+        df[COL_LAT] = df[COL_LON] = np.nan
+        return np.zeros(len(sensors), dtype=bool)
+    pos = np.minimum(np.searchsorted(ids, sensors), len(ids) - 1)
+    known = ids[pos] == sensors
+    df[COL_LAT] = np.where(known, lats[pos], np.nan)
+    df[COL_LON] = np.where(known, lons[pos], np.nan)
+    return known
+
+
+def _fetch_locations(
+    sensor_type: str, unknown: np.ndarray, max_date: str | None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Request the positions of sensors missing from the known locations, and
+    add them there. Must be called holding _fetched_locations_lock.
+
+    Sensors the endpoint doesn't report are added without a position, so
+    each sensor is requested at most once per process.
+    """
+    info = TB_PIPES[sensor_type]
+    fallback_params = {info[TB_SENSORS_PARAM]: ",".join(str(sid) for sid in unknown)}
+    if max_date:
+        fallback_params["max_date"] = max_date
+    fallback = _process(_fetch(info[TB_NOW_PIPE], fallback_params))
+    new_lats = new_lons = np.full(len(unknown), np.nan)
+    if fallback is not None:
+        positions = fallback.drop_duplicates(subset=[COL_SENSOR]).set_index(COL_SENSOR)
+        new_lats = positions[COL_LAT].reindex(unknown).to_numpy(dtype=np.float64)
+        new_lons = positions[COL_LON].reindex(unknown).to_numpy(dtype=np.float64)
+    ids, lats, lons = known_locations(sensor_type)
+    ids = np.concatenate([ids, unknown])
+    order = np.argsort(ids, kind="stable")
+    merged = (
+        ids[order],
+        np.concatenate([lats, new_lats])[order],
+        np.concatenate([lons, new_lons])[order],
+    )
+    _fetched_locations[sensor_type] = merged
+    return merged
+
+
+# label of the balizas API in the metrics, next to the Tinybird pipe names
+BALIZAS_SOURCE = "balizas"
 
 
 def decode_baliza_payload(encoded: str) -> dict:
@@ -222,9 +470,24 @@ def load_balizas_data() -> pd.DataFrame | None:
         "x-api-key": "1j74ls84yj",
     }
 
-    response = requests.get(url, headers=headers, timeout=10)
-    response.raise_for_status()
-    data = decode_baliza_payload(response.text)
+    with metrics.span("load", logging.INFO, pipe=BALIZAS_SOURCE) as load:
+        with metrics.span("network", pipe=BALIZAS_SOURCE):
+            response = requests.get(url, headers=headers, timeout=10)
+            response.raise_for_status()
+        metrics.inc(metrics.RECEIVED_BYTES, len(response.content), pipe=BALIZAS_SOURCE)
+        with metrics.span("normalize", pipe=BALIZAS_SOURCE):
+            df = _process_balizas(response.text)
+        load["rows"] = len(df)
+    return df
+
+
+def load_balizas_snapshot() -> pd.DataFrame | None:
+    """Latest balizas, shared by all the sessions (see SNAPSHOT_TTL)."""
+    return _snapshot(BALIZAS_SOURCE, lambda: load_balizas_data())
+
+
+def _process_balizas(payload: str) -> pd.DataFrame:
+    data = decode_baliza_payload(payload)
     df = pd.DataFrame(data["balizas"])
     # Normalize to standard columns
     df[COL_LAT] = pd.to_numeric(df["lat"])
@@ -278,6 +541,58 @@ def load_sensor_addresses() -> dict:
         return {"sensors": {}}
 
 
+def align_sensor_series(df: pd.DataFrame, y_axis: str) -> pd.DataFrame:
+    """Pivot a multi-sensor history into one column per sensor.
+
+    Readings are bucketed to ALIGN_FREQ so that every sensor shares the same
+    time index, even if their update times differ by a few minutes.
+    """
+    bucket = df[COL_DATETIME].dt.floor(ALIGN_FREQ)
+    aligned = df.pivot_table(
+        index=bucket, columns=COL_SENSOR, values=y_axis, aggfunc="mean", dropna=False
+    )
+    full_index = pd.date_range(
+        aligned.index.min(), aligned.index.max(), freq=ALIGN_FREQ
+    )
+    return aligned.reindex(full_index).rename_axis(index=COL_DATETIME)
+
+
+@lru_cache(maxsize=8)
+def sensor_locations(sensor_type: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Known sensor positions (ids, lats, lons) sorted by sensor id.
+
+    Built once from the sensor addresses file, as plain arrays so that
+    positions can be joined to any response with a binary search.
+    """
+    ids, lats, lons = [], [], []
+    for key, sensor in load_sensor_addresses().get("sensors", {}).items():
+        if sensor.get("sensor_type") != sensor_type:
+            continue
+        ids.append(int(key.rsplit("_", 1)[1]))
+        lats.append(sensor["lat"])
+        lons.append(sensor["lon"])
+    order = np.argsort(np.asarray(ids, dtype=np.int64), kind="stable")
+    return (
+        np.asarray(ids, dtype=np.int64)[order],
+        np.asarray(lats, dtype=np.float64)[order],
+        np.asarray(lons, dtype=np.float64)[order],
+    )
+
+
+# positions of the sensors missing from the static table, requested from the
+# *_now endpoints (see _attach_locations), merged with the static ones
+_fetched_locations: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+_fetched_locations_lock = threading.Lock()
+
+
+def known_locations(sensor_type: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sensor positions (ids, lats, lons) sorted by sensor id: the static
+    table plus the positions fetched so far by this process (NaN for the
+    sensors the endpoints didn't report)."""
+    fetched = _fetched_locations.get(sensor_type)
+    return fetched if fetched is not None else sensor_locations(sensor_type)
+
+
 def get_sensor_display_name(sensor_id: int | str, sensor_type: str) -> str:
     """Get display name for a sensor (ID - Address format).
 
@@ -291,3 +606,25 @@ def get_sensor_display_name(sensor_id: int | str, sensor_type: str) -> str:
         return sensor_data.get("display_name", str(sensor_id))
 
     return str(sensor_id)
+
+
+def get_sensor_street(sensor_id: int | str, sensor_type: str) -> str | None:
+    """Get the street of a sensor (first component of its address)."""
+    addresses = load_sensor_addresses()
+    sensor_data = addresses.get("sensors", {}).get(f"{sensor_type}_{sensor_id}")
+    if sensor_data and sensor_data.get("address"):
+        return sensor_data["address"].split(",")[0].strip()
+    return None
+
+
+def sensors_by_street(sensor_ids, sensor_type: str) -> dict[str, list[int]]:
+    """Group the given sensor ids by the street they are located in.
+
+    Sensors without a known address are left out.
+    """
+    streets: dict[str, list[int]] = {}
+    for sid in sorted(int(s) for s in sensor_ids):
+        street = get_sensor_street(sid, sensor_type)
+        if street:
+            streets.setdefault(street, []).append(sid)
+    return dict(sorted(streets.items()))
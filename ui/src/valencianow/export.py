@@ -0,0 +1,236 @@
+"""export the history of a datasource (or of its *_history pipe) to Parquet.
+
+The range is requested in time windows, a few of them at a time, and each
+window is normalized like in the application and written to its own file in
+<out>.parts/, so an interrupted export continues where it stopped. The
+windows are then appended to <out> one by one, so memory doesn't depend on
+the length of the range. Dates are in Spain local time, like in the UI:
+
+    valencianow export cars --start "2025-01-01" --end "2026-01-01" --out cars.parquet
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from valencianow import config, data, mirror
+
+logger = config.logger
+
+# exportable pipes, by their name and the name of their datasource. The per
+# day (or day of week) averages can't be computed window by window
+PIPES = {
+    **{info[data.TB_HIST_PIPE]: label for label, info in data.TB_PIPES.items()},
+    **{datasource: label for label, datasource in mirror.DATASOURCES.items()},
+}
+DEFAULT_WINDOW_HOURS = 24
+DEFAULT_CONCURRENCY = 4
+MANIFEST = "manifest.json"
+# written instead of a Parquet file for windows without rows
+EMPTY_SUFFIX = ".empty"
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+
+class ExportError(ValueError):
+    pass
+
+
+def windows(
+    start: datetime.datetime, end: datetime.datetime, size: datetime.timedelta
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """Consecutive [start, end) ranges covering the given one."""
+    bounds = []
+    while start < end:
+        bounds.append((start, min(start + size, end)))
+        start += size
+    return bounds
+
+
+def _part(parts_dir: str, start: datetime.datetime) -> str:
+    return os.path.join(parts_dir, f"{start:%Y%m%dT%H%M%S}.parquet")
+
+
+def _export_window(
+    pipe: str,
+    params: dict,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    path: str,
+) -> int:
+    """Load a window and write it to its part file. Returns its rows."""
+    params = {
+        **params,
+        "min_date": start.strftime(mirror.DATE_FORMAT),
+        "max_date": (end - datetime.timedelta(seconds=1)).strftime(mirror.DATE_FORMAT),
+    }
+    df = data._load(pipe, params)
+    if df is None:
+        open(f"{path}{EMPTY_SUFFIX}", "w").close()
+        return 0
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    return len(df)
+
+
+def _check_manifest(parts_dir: str, manifest: dict) -> None:
+    """Fail if the parts directory belongs to a different export."""
+    path = os.path.join(parts_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            if json.load(f) != manifest:
+                raise ExportError(
+                    f"{parts_dir} has the parts of a different export, remove it "
+                    "or export with the same arguments to continue it"
+                )
+        return
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+
+def _merge(parts: list[str], out: str) -> int:
+    """Append the part files to a single Parquet file, one at a time."""
+    files = [path for path in parts if os.path.exists(path)]
+    if not files:
+        return 0
+    schema = pa.unify_schemas(
+        [pq.read_schema(path) for path in files], promote_options="permissive"
+    )
+    rows = 0
+    with pq.ParquetWriter(f"{out}.tmp", schema) as writer:
+        for path in files:
+            table = pq.read_table(path)
+            writer.write_table(table.select(schema.names).cast(schema))
+            rows += table.num_rows
+    os.replace(f"{out}.tmp", out)
+    return rows
+
+
+def export(
+    pipe: str,
+    out: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    sensors: list[int] | None = None,
+    window: datetime.timedelta = datetime.timedelta(hours=DEFAULT_WINDOW_HOURS),
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> int:
+    """Export the history between start and end (UTC) to a Parquet file.
+
+    Windows already exported to <out>.parts/ by an interrupted export with
+    the same arguments are not requested again. Returns the exported rows,
+    ExportError is raised if there are none.
+    """
+    label = PIPES[pipe]
+    info = data.TB_PIPES[label]
+    pipe = info[data.TB_HIST_PIPE]
+    params = {"lean": "true"}
+    if sensors:
+        params[info[data.TB_SENSORS_PARAM]] = ",".join(str(s) for s in sensors)
+    parts_dir = f"{out}.parts"
+    _check_manifest(
+        parts_dir,
+        {
+            "pipe": pipe,
+            "sensors": sensors,
+            "start": start.strftime(mirror.DATE_FORMAT),
+            "end": end.strftime(mirror.DATE_FORMAT),
+            "window_seconds": window.total_seconds(),
+        },
+    )
+    bounds = windows(start, end, window)
+    parts = [_part(parts_dir, window_start) for window_start, _ in bounds]
+    pending = [
+        (bound, path)
+        for bound, path in zip(bounds, parts)
+        if not os.path.exists(path) and not os.path.exists(f"{path}{EMPTY_SUFFIX}")
+    ]
+    logger.info(f"Exporting {len(pending)} of {len(bounds)} windows of {pipe}")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(_export_window, pipe, params, *bound, path)
+            for bound, path in pending
+        ]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                logger.info(f"Exported {done}/{len(pending)} windows")
+        except BaseException:
+            # exported windows are kept, to continue the export later
+            pool.shutdown(cancel_futures=True)
+            raise
+    rows = _merge(parts, out)
+    shutil.rmtree(parts_dir)
+    if not os.path.exists(out):
+        # the windows had no rows, so there is no schema to write
+        raise ExportError(
+            f"{pipe} has no readings between {start} and {end} (UTC), "
+            "nothing was exported"
+        )
+    logger.info(f"Exported {rows} rows of {pipe} to {out}")
+    return rows
+
+
+def _local_date(value: str) -> datetime.datetime:
+    """A Spain local date (or datetime) argument, as UTC."""
+    for date_format in DATE_FORMATS:
+        try:
+            local = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        utc = data._date_to_utc(local.strftime(mirror.DATE_FORMAT))
+        return datetime.datetime.strptime(utc, mirror.DATE_FORMAT)
+    raise argparse.ArgumentTypeError(f"invalid date: {value}")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="valencianow export",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("pipe", choices=sorted(PIPES), help="datasource or pipe")
+    parser.add_argument("--start", type=_local_date, required=True)
+    parser.add_argument("--end", type=_local_date, required=True)
+    parser.add_argument("--out", required=True, help="Parquet file to write")
+    parser.add_argument(
+        "--sensors", type=int, nargs="+", help="sensor ids (all by default)"
+    )
+    parser.add_argument(
+        "--window-hours",
+        type=float,
+        default=DEFAULT_WINDOW_HOURS,
+        help="range of each request",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="requests in flight at once",
+    )
+    args = parser.parse_args(argv)
+    if args.end <= args.start:
+        parser.error("--end must be after --start")
+    config.validate()
+    try:
+        export(
+            args.pipe,
+            args.out,
+            args.start,
+            args.end,
+            args.sensors,
+            datetime.timedelta(hours=args.window_hours),
+            args.concurrency,
+        )
+    except ExportError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
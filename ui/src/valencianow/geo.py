@@ -0,0 +1,226 @@
+"""spatial index over sensor coordinates, to answer radius, bounding box
+and nearest-sensor queries without touching the network"""
+
+import math
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from valencianow import config, data
+
+EARTH_RADIUS_M = 6_371_000
+# side of each grid bucket, in meters. Sensors are a few hundred meters apart
+# in the city center, so most buckets hold a handful of sensors
+CELL_SIZE_M = 250
+# a literal "lat, lon" location typed by the user
+LAT_LON_RE = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+# shorter street queries match too many streets to be useful
+MIN_QUERY_LENGTH = 3
+
+_COS_LAT0 = math.cos(math.radians(config.VALENCIA_LAT))
+
+
+def _project(lats, lons) -> tuple[np.ndarray, np.ndarray]:
+    """Equirectangular projection to meters around Valencia.
+
+    Distortion is negligible at city scale, so plain euclidean distances can
+    be used in the projected space.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    x = np.radians(lons - config.VALENCIA_LON) * EARTH_RADIUS_M * _COS_LAT0
+    y = np.radians(lats - config.VALENCIA_LAT) * EARTH_RADIUS_M
+    return x, y
+
+
+class SensorIndex:
+    """Grid bucket map over sensor positions.
+
+    Each sensor is stored in the bucket of a regular CELL_SIZE_M grid, so
+    queries only compute distances for the sensors of nearby buckets.
+    """
+
+    def __init__(self, ids, lats, lons, cell_size: float = CELL_SIZE_M):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_size = cell_size
+        self._x, self._y = _project(self.lats, self.lons)
+        cells_x = np.floor(self._x / cell_size).astype(np.int64)
+        cells_y = np.floor(self._y / cell_size).astype(np.int64)
+        buckets: dict[tuple[int, int], list[int]] = {}
+        for i, cell in enumerate(zip(cells_x.tolist(), cells_y.tolist())):
+            buckets.setdefault(cell, []).append(i)
+        self._buckets = {
+            cell: np.array(idx, dtype=np.int64) for cell, idx in buckets.items()
+        }
+        if len(self.ids):
+            self._extent = (
+                int(cells_x.min()),
+                int(cells_y.min()),
+                int(cells_x.max()),
+                int(cells_y.max()),
+            )
+        else:
+            self._extent = (0, 0, -1, -1)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _cell(self, x: float, y: float) -> tuple[int, int]:
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _candidates(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        """Positions of the sensors stored in the given range of buckets."""
+        min_x, min_y, max_x, max_y = self._extent
+        x0, y0 = max(x0, min_x), max(y0, min_y)
+        x1, y1 = min(x1, max_x), min(y1, max_y)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._buckets):
+            # large ranges hold more (mostly empty) cells than buckets
+            found = [
+                idx
+                for (cx, cy), idx in self._buckets.items()
+                if x0 <= cx <= x1 and y0 <= cy <= y1
+            ]
+        else:
+            found = [
+                self._buckets[(cx, cy)]
+                for cx in range(x0, x1 + 1)
+                for cy in range(y0, y1 + 1)
+                if (cx, cy) in self._buckets
+            ]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def _distances(self, idx: np.ndarray, x: float, y: float) -> np.ndarray:
+        return np.hypot(self._x[idx] - x, self._y[idx] - y)
+
+    def within_radius(self, lat: float, lon: float, meters: float) -> np.ndarray:
+        """Ids of the sensors at most `meters` away, sorted by distance."""
+        (x,), (y,) = _project([lat], [lon])
+        x0, y0 = self._cell(x - meters, y - meters)
+        x1, y1 = self._cell(x + meters, y + meters)
+        idx = self._candidates(x0, y0, x1, y1)
+        dist = self._distances(idx, x, y)
+        keep = dist <= meters
+        return self.ids[idx[keep][np.argsort(dist[keep], kind="stable")]]
+
+    def in_bbox(self, south: float, west: float, north: float, east: float):
+        """Ids of the sensors inside the given bounding box."""
+        (x0, x1), (y0, y1) = _project([south, north], [west, east])
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        idx = self._candidates(cx0, cy0, cx1, cy1)
+        lats, lons = self.lats[idx], self.lons[idx]
+        keep = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+        return self.ids[idx[keep]]
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> list[tuple[int, float]]:
+        """The k sensors closest to a location, as (id, distance in meters)."""
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        (x,), (y,) = _project([lat], [lon])
+        cx, cy = self._cell(x, y)
+        min_x, min_y, max_x, max_y = self._extent
+        max_ring = max(
+            abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y)
+        )
+        # smaller rings don't reach any bucket when searching from outside
+        ring = max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+        while True:
+            idx = self._candidates(cx - ring, cy - ring, cx + ring, cy + ring)
+            if len(idx) >= k:
+                dist = self._distances(idx, x, y)
+                order = np.argsort(dist, kind="stable")[:k]
+                # any sensor outside the searched square is at least
+                # `ring` cells away, so the result can't improve any more
+                if (
+                    dist[order[-1]] <= ring * self.cell_size
+                    or ring >= max_ring
+                    or len(idx) == len(self)
+                ):
+                    return [(int(self.ids[idx[i]]), float(dist[i])) for i in order]
+            ring += 1
+
+
+@lru_cache(maxsize=8)
+def _static_index(sensor_type: str) -> SensorIndex:
+    return SensorIndex(*data.sensor_locations(sensor_type))
+
+
+def sensor_index(sensor_type: str, snapshot: pd.DataFrame | None = None) -> SensorIndex:
+    """Spatial index of the sensors of the given type.
+
+    Sensors found in the latest snapshot but missing from the static file are
+    added with the coordinates reported by the endpoint.
+    """
+    index = _static_index(sensor_type)
+    if snapshot is None or not {data.COL_LAT, data.COL_LON} <= set(snapshot.columns):
+        return index
+    rows = snapshot.loc[~snapshot[data.COL_SENSOR].isin(index.ids.tolist())]
+    rows = rows.dropna(subset=[data.COL_LAT, data.COL_LON])
+    rows = rows.drop_duplicates(subset=[data.COL_SENSOR])
+    if rows.empty:
+        return index
+    return SensorIndex(
+        np.concatenate([index.ids, rows[data.COL_SENSOR].to_numpy(np.int64)]),
+        np.concatenate([index.lats, rows[data.COL_LAT].to_numpy(np.float64)]),
+        np.concatenate([index.lons, rows[data.COL_LON].to_numpy(np.float64)]),
+    )
+
+
+def _normalize(text: str) -> str:
+    """Lowercase text without accents, so "jativa" matches "Játiva"."""
+    decomposed = unicodedata.normalize("NFKD", text.strip().lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def matching_streets(query: str) -> dict[str, tuple[float, float]]:
+    """Streets of the sensor addresses file matching a query, with the mean
+    position of their sensors.
+
+    A street matches when the query is the start of one of its words (or of
+    several consecutive words), so "jat" matches "Calle de Játiva" but "tiva"
+    doesn't. Queries shorter than MIN_QUERY_LENGTH match nothing.
+    """
+    query = _normalize(query)
+    if len(query) < MIN_QUERY_LENGTH:
+        return {}
+    pattern = re.compile(rf"\b{re.escape(query)}")
+    positions: dict[str, list[tuple[float, float]]] = {}
+    for sensor in data.load_sensor_addresses().get("sensors", {}).values():
+        street = sensor.get("address", "").split(",")[0].strip()
+        if street and pattern.search(_normalize(street)):
+            positions.setdefault(street, []).append((sensor["lat"], sensor["lon"]))
+    exact = [street for street in positions if _normalize(street) == query]
+    if exact:
+        positions = {street: positions[street] for street in exact}
+    return {
+        street: (
+            sum(lat for lat, _ in points) / len(points),
+            sum(lon for _, lon in points) / len(points),
+        )
+        for street, points in sorted(positions.items())
+    }
+
+
+def locate(query: str) -> tuple[float, float] | None:
+    """Resolve a 'lat, lon' string or a street of a known sensor to coordinates.
+
+    Streets are matched against the static sensor addresses file (see
+    matching_streets), so no geocoding service is called. None is returned
+    when no street or several of them match, use matching_streets to tell
+    these cases apart.
+    """
+    match = LAT_LON_RE.match(query)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    streets = matching_streets(query)
+    if len(streets) != 1:
+        return None
+    return next(iter(streets.values()))
@@ -0,0 +1,52 @@
+"""start the application with warm caches.
+
+Validates the configuration and starts the metrics server (see
+valencianow.metrics), then starts the Streamlit server while the
+latest snapshots are loaded (and the plotting libraries are imported) in the
+background. A marker file is written once they are ready, for the container
+health check. Arguments are passed to `streamlit run`.
+"""
+
+import contextlib
+import importlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from streamlit.web import cli
+
+from valencianow import config, data, metrics
+
+logger = config.logger
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+READY_FILE = os.environ.get("VALENCIANOW_READY_FILE", "/tmp/valencianow.ready")
+# libraries imported lazily by the application, needed by the first render
+RENDER_MODULES = ("plotly.express", "pydeck")
+
+
+def prewarm() -> None:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(data.prewarm)
+        for module in RENDER_MODULES:
+            importlib.import_module(module)
+    with open(READY_FILE, "w", encoding="utf-8") as f:
+        f.write(f"{time.time()}\n")
+    logger.info(f"Prewarmed in {time.perf_counter() - start:.2f} s")
+
+
+def main() -> None:
+    config.validate()
+    metrics.start_server()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(READY_FILE)
+    threading.Thread(target=prewarm, daemon=True).start()
+    sys.argv = ["streamlit", "run", APP_PATH, *sys.argv[1:]]
+    sys.exit(cli.main())
+
+
+if __name__ == "__main__":
+    main()
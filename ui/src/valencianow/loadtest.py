@@ -0,0 +1,436 @@
+"""load test of the application with concurrent Streamlit sessions.
+
+Runs the application with `streamlit run`, backed by the local Tinybird
+stand-in (valencianow.localbird) with a configurable latency, and connects
+simulated viewers to it through the Streamlit websocket protocol, like
+browsers do. Each viewer opens the app (which renders all the tabs),
+changes the date of the car tab and queries a sensor over the last year.
+The balizas API is not called.
+
+Reports rerun latency percentiles, CPU usage and memory per session of the
+Streamlit server (read from /proc, so Linux only), and the requests it sent
+to Tinybird (read from its metrics endpoint).
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from streamlit.testing.v1.element_tree import parse_tree_from_messages
+
+from valencianow import config, metrics, synthetic
+
+try:
+    from websockets.sync.client import connect
+    from websockets.typing import Subprotocol
+except ImportError as e:
+    # websockets is a development dependency, not installed in the image
+    raise ImportError(
+        "valencianow.loadtest needs the development dependencies, "
+        "install them with `uv sync` (without --no-dev)"
+    ) from e
+
+logger = config.logger
+
+# application script run by the Streamlit server: the real app, without the
+# balizas API (an external service that must not be load tested)
+APP_SCRIPT = """\
+from valencianow import app, data
+
+data.load_balizas_data = lambda: None
+app.main()
+"""
+# steps of the flow of each viewer
+ACTIONS = ("open", "change_date", "sensor_last_year")
+PERCENTILES = (50, 90, 95, 99)
+# seconds to wait for the servers to accept connections
+STARTUP_TIMEOUT = 120
+METRIC_LINE_RE = re.compile(r'^(\w+)\{pipe="(\w+)"(?:,stage="(\w+)")?\} (\S+)$')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(process: subprocess.Popen, port: int, name: str) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} exited before starting")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{name} did not start in time")
+
+
+def start_tinybird(project_dir: str, data_dir: str, latency_ms: float, output=None):
+    """Run the local Tinybird, returning its process and url."""
+    port = _free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "valencianow.localbird",
+            f"--project={project_dir}",
+            f"--data={data_dir}",
+            f"--port={port}",
+            f"--latency-ms={latency_ms}",
+        ],
+        stdout=output,
+        stderr=output,
+    )
+    _wait_for_port(process, port, "The local Tinybird")
+    return process, f"http://127.0.0.1:{port}"
+
+
+def start_app(script_path: str, tinybird_url: str, output=None):
+    """Run the application, returning its process, port and metrics port."""
+    port, metrics_port = _free_port(), _free_port()
+    env = {
+        **os.environ,
+        "TINYBIRD_HOST": tinybird_url,
+        "TINYBIRD_TOKEN": "loadtest",
+        "VALENCIANOW_METRICS_PORT": str(metrics_port),
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            script_path,
+            f"--server.port={port}",
+            "--server.headless=true",
+            "--browser.gatherUsageStats=false",
+        ],
+        env=env,
+        stdout=output,
+        stderr=output,
+    )
+    _wait_for_port(process, port, "The Streamlit server")
+    return process, port, metrics_port
+
+
+def _rss(pid: int) -> int:
+    """Resident memory of a process, in bytes."""
+    with open(f"/proc/{pid}/statm", encoding="utf-8") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+        # the process name (2nd field) is in parentheses and can have spaces
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def upstream_requests(metrics_port: int) -> dict[str, dict[str, float]]:
+    """Requests and bytes received from Tinybird so far, by pipe."""
+    url = f"http://127.0.0.1:{metrics_port}/metrics"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        text = response.read().decode("utf-8")
+    upstream: dict[str, dict[str, float]] = {}
+    for line in text.splitlines():
+        match = METRIC_LINE_RE.match(line)
+        if not match:
+            continue
+        name, pipe, stage, value = match.groups()
+        values = upstream.setdefault(pipe, {"requests": 0, "bytes": 0})
+        if name == f"{metrics.STAGE_SECONDS}_count" and stage == "network":
+            values["requests"] = int(value)
+        elif name == metrics.RECEIVED_BYTES:
+            values["bytes"] = float(value)
+    return upstream
+
+
+class Viewer:
+    """A browser tab connected to the application."""
+
+    def __init__(self, port: int, timeout: float):
+        self.timeout = timeout
+        self._exit_stack = contextlib.ExitStack()
+        self.websocket = self._exit_stack.enter_context(
+            connect(
+                f"ws://127.0.0.1:{port}/_stcore/stream",
+                subprotocols=[Subprotocol("streamlit")],
+                max_size=None,
+                open_timeout=timeout,
+            )
+        )
+
+    def rerun(self, states=()) -> tuple[float, list[ForwardMsg]]:
+        """Rerun the script with the given widget states.
+
+        Returns the time until the script finished, and the messages sent
+        by the server meanwhile.
+        """
+        msg = BackMsg()
+        msg.rerun_script.widget_states.widgets.extend(states)
+        start = time.perf_counter()
+        self.websocket.send(msg.SerializeToString())
+        messages = []
+        while True:
+            forward_msg = ForwardMsg()
+            forward_msg.ParseFromString(self.websocket.recv(self.timeout, decode=False))
+            messages.append(forward_msg)
+            if forward_msg.HasField("script_finished"):
+                return time.perf_counter() - start, messages
+
+    def close(self) -> None:
+        self._exit_stack.close()
+
+
+def _by_label(widgets, label: str):
+    """First widget with the given label (the car tab is rendered first)."""
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise RuntimeError(f"Widget not found: {label}")
+
+
+def _radio_state(radio, option: str) -> WidgetState:
+    """State of a radio with the given option selected.
+
+    AppTest needs the session state of the script to compute it, which only
+    lives in the server here.
+    """
+    state = WidgetState(id=radio.id)
+    options = list(radio.proto.options)
+    if "raw_value" in radio.proto.DESCRIPTOR.fields_by_name:
+        state.string_value = option
+    else:
+        # older Streamlit versions send the index of the option
+        state.int_value = options.index(option)
+    return state
+
+
+def _rerun(viewer: Viewer, action: str, timings: dict, states=()):
+    """Rerun the script, returning the element tree of the result."""
+    timings[action], messages = viewer.rerun(states)
+    tree = parse_tree_from_messages(messages)
+    if len(tree.exception):
+        raise RuntimeError(f"{action}: {tree.exception[0].message}")
+    return tree
+
+
+def run_viewer(
+    port: int, max_date: datetime.datetime, timeout: float
+) -> tuple[Viewer, dict[str, float]]:
+    """Run the flow of a viewer, returning it and its rerun latencies."""
+    timings: dict[str, float] = {}
+    viewer = Viewer(port, timeout)
+    tree = _rerun(viewer, "open", timings)
+    widgets = [
+        _by_label(tree.date_input, "Select max date").set_value(max_date.date()),
+        _by_label(tree.time_input, "Select max time").set_value(max_date.time()),
+        _by_label(tree.button, "📅⠀Change date").click(),
+    ]
+    _rerun(viewer, "change_date", timings, [w._widget_state for w in widgets])
+    states = [
+        _radio_state(_by_label(tree.radio, "Select a time span: "), "Last Year"),
+        _by_label(tree.button, "🔎 Find sensor data").click()._widget_state,
+    ]
+    _rerun(viewer, "sensor_last_year", timings, states)
+    return viewer, timings
+
+
+def load_test(
+    pid: int,
+    port: int,
+    metrics_port: int,
+    max_date: datetime.datetime,
+    sessions: int,
+    rounds: int,
+    timeout: float,
+) -> dict:
+    """Run `sessions` concurrent viewers, `rounds` times each."""
+    # the first viewer makes the server import and initialize everything
+    warmup, _ = run_viewer(port, max_date, timeout)
+    warmup.close()
+    rss_before, cpu_before = _rss(pid), _cpu_seconds(pid)
+    upstream_before = upstream_requests(metrics_port)
+    latencies: dict[str, list[float]] = {action: [] for action in ACTIONS}
+    errors: list[str] = []
+    viewers: list[Viewer] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def simulate() -> None:
+        barrier.wait()
+        for _ in range(rounds):
+            # timeouts, closed connections and failed reruns are reported
+            try:
+                viewer, timings = run_viewer(port, max_date, timeout)
+            except (RuntimeError, OSError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                viewers.append(viewer)
+                for action, seconds in timings.items():
+                    latencies[action].append(seconds)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=simulate) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    # viewers are still connected, so their sessions are still in memory
+    rss_after, cpu = _rss(pid), _cpu_seconds(pid) - cpu_before
+    upstream = upstream_requests(metrics_port)
+    for viewer in viewers:
+        viewer.close()
+
+    for pipe, values in upstream_before.items():
+        upstream[pipe]["requests"] -= values["requests"]
+        upstream[pipe]["bytes"] -= values["bytes"]
+    upstream = {pipe: values for pipe, values in upstream.items() if values["requests"]}
+    total_requests = sum(values["requests"] for values in upstream.values())
+    completed = max(len(viewers), 1)
+    return {
+        "sessions": sessions,
+        "rounds": rounds,
+        "wall_s": round(wall, 2),
+        "errors": errors,
+        "rerun_ms": {
+            action: {
+                "count": len(values),
+                **{
+                    f"p{p}": round(float(np.percentile(values, p)) * 1000, 1)
+                    for p in PERCENTILES
+                },
+                "max": round(max(values) * 1000, 1),
+            }
+            for action, values in latencies.items()
+            if values
+        },
+        "cpu": {"seconds": round(cpu, 2), "cores": round(cpu / wall, 2)},
+        "rss_mib": {
+            "before": round(rss_before / 2**20, 1),
+            "after": round(rss_after / 2**20, 1),
+            "per_session": round((rss_after - rss_before) / completed / 2**20, 2),
+        },
+        "upstream": {
+            pipe: {
+                "requests": values["requests"],
+                "kib": round(values["bytes"] / 1024, 1),
+            }
+            for pipe, values in sorted(upstream.items())
+        },
+        "upstream_requests_per_session": round(total_requests / completed, 1),
+    }
+
+
+def print_report(results: dict) -> None:
+    print(
+        f"\n{results['sessions']} sessions x {results['rounds']} rounds "
+        f"in {results['wall_s']} s, {len(results['errors'])} errors"
+    )
+    print("\nRerun latency (ms)")
+    columns = ["count", *(f"p{p}" for p in PERCENTILES), "max"]
+    print(f"  {'action':<18}" + "".join(f"{c:>9}" for c in columns))
+    for action, values in results["rerun_ms"].items():
+        print(f"  {action:<18}" + "".join(f"{values[c]:>9}" for c in columns))
+    cpu, rss = results["cpu"], results["rss_mib"]
+    print(f"\nCPU: {cpu['seconds']} s ({cpu['cores']} cores on average)")
+    print(
+        f"RSS: {rss['before']} MiB -> {rss['after']} MiB "
+        f"({rss['per_session']} MiB per session)"
+    )
+    print("\nTinybird requests")
+    for pipe, values in results["upstream"].items():
+        print(f"  {pipe:<28}{values['requests']:>6} {values['kib']:>10} KiB")
+    print(f"  per session: {results['upstream_requests_per_session']}")
+    for error in results["errors"][:10]:
+        print(f"\nError: {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent viewers")
+    parser.add_argument("--rounds", type=int, default=1, help="flows per viewer")
+    parser.add_argument(
+        "--latency-ms", type=float, default=50, help="latency of Tinybird requests"
+    )
+    parser.add_argument("--project", default="../tinybird", help="tinybird folder")
+    parser.add_argument(
+        "--data", help="folder with Parquet files (synthetic data by default)"
+    )
+    parser.add_argument(
+        "--days", type=int, default=31, help="days of synthetic data, without --data"
+    )
+    parser.add_argument("--timeout", type=float, default=300, help="seconds per rerun")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the servers"
+    )
+    args = parser.parse_args()
+    output = None if args.verbose else subprocess.DEVNULL
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data
+        end = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            start = end - datetime.timedelta(days=args.days)
+            for datasource in synthetic.DATASOURCES:
+                synthetic.write_parquet(data_dir, datasource, start, end)
+        script_path = os.path.join(tmp_dir, "app.py")
+        with open(script_path, "w", encoding="utf-8") as f:
+            f.write(APP_SCRIPT)
+        processes = []
+        try:
+            tinybird, url = start_tinybird(
+                args.project, data_dir, args.latency_ms, output
+            )
+            processes.append(tinybird)
+            app, port, metrics_port = start_app(script_path, url, output)
+            processes.append(app)
+            # about a day before the latest data
+            max_date = (end - datetime.timedelta(days=1)).replace(
+                minute=0, second=0, microsecond=0
+            )
+            results = load_test(
+                app.pid,
+                port,
+                metrics_port,
+                max_date,
+                args.sessions,
+                args.rounds,
+                args.timeout,
+            )
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+    results["latency_ms"] = args.latency_ms
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
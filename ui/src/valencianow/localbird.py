@@ -0,0 +1,432 @@
+"""local stand-in for the Tinybird API.
+
+Serves the endpoints of the tinybird/ folder (`/v0/pipes/<name>.<format>`) and
+accepts appends (`/v0/events?name=<datasource>`) using local Parquet files and
+an embedded ClickHouse engine (chDB), so the pipes' SQL runs unchanged. Only
+their templates are rendered here, supporting the helpers used by the pipes.
+Point the application to it with TINYBIRD_HOST=http://localhost:7181.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from valencianow import config
+
+try:
+    from chdb import session as chdb_session
+except ImportError as e:
+    # chDB is a development dependency, not installed in the image
+    raise ImportError(
+        "valencianow.localbird needs the development dependencies, "
+        "install them with `uv sync` (without --no-dev)"
+    ) from e
+
+logger = config.logger
+
+DEFAULT_PORT = 7181
+# response formats supported by the pipes endpoint: (chDB format, content type)
+FORMATS = {
+    "csv": ("CSVWithNames", "text/csv"),
+    "json": ("JSON", "application/json"),
+    "ndjson": ("JSONEachRow", "application/x-ndjson"),
+    "parquet": ("Parquet", "application/octet-stream"),
+}
+PIPE_URL_RE = re.compile(r"^/v0/pipes/(\w+)\.(\w+)$")
+SCHEMA_COLUMN_RE = re.compile(r"^`(\w+)`\s+(.+?)(?:\s+`json:[^`]*`)?\s*,?$")
+TEMPLATE_TOKEN_RE = re.compile(r"({%.*?%}|{{.*?}})", re.DOTALL)
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+
+
+class TemplateError(ValueError):
+    """Invalid template, or invalid parameters for it."""
+
+
+def parse_datafile(text: str) -> dict:
+    """Parse a Tinybird datafile (.datasource or .pipe).
+
+    Multi-line directives (`KEY >` followed by an indented block) are returned
+    as text. Directives found after a NODE belong to that node, and nodes are
+    returned in order under the "nodes" key.
+    """
+    parsed: dict = {"nodes": []}
+    target, block_key, block = parsed, None, []
+
+    def close_block():
+        if block_key:
+            target[block_key] = "\n".join(block).strip("\n")
+
+    for line in text.splitlines():
+        if block_key and (line.startswith((" ", "\t")) or not line.strip()):
+            block.append(line[4:] if line.startswith("    ") else line.strip())
+            continue
+        close_block()
+        block_key, block = None, []
+        if not line.strip():
+            continue
+        key, _, value = line.strip().partition(" ")
+        value = value.strip()
+        if key == "NODE":
+            target = {"name": value}
+            parsed["nodes"].append(target)
+        elif value == ">":
+            block_key = key
+        else:
+            target[key] = value.strip('"')
+    close_block()
+    return parsed
+
+
+def schema_columns(schema: str) -> list[tuple[str, str]]:
+    """Column names and types of a datasource SCHEMA."""
+    columns = []
+    for line in schema.splitlines():
+        match = SCHEMA_COLUMN_RE.match(line.strip())
+        if match:
+            columns.append((match.group(1), match.group(2)))
+    return columns
+
+
+class _Undefined:
+    """Value of the template variables not given as request parameters."""
+
+    def __bool__(self):
+        return False
+
+
+UNDEFINED = _Undefined()
+
+
+class _Params(dict):
+    def __missing__(self, key):
+        return UNDEFINED
+
+
+def _value(value, default, name: str):
+    if value is UNDEFINED or value is None:
+        if default is None:
+            raise TemplateError(f"Missing required parameter of type {name}")
+        return default
+    return value
+
+
+def _sql_string(value) -> str:
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _number(name: str, cast):
+    def helper(value=UNDEFINED, default=None, *args, **kwargs):
+        value = _value(value, default, name)
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise TemplateError(f"Invalid {name} value: {value}") from None
+
+    return helper
+
+
+def _datetime(value=UNDEFINED, default=None, *args, **kwargs) -> str:
+    value = _value(value, default, "DateTime")
+    for fmt in DATETIME_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(str(value), fmt)
+        except ValueError:
+            continue
+        return _sql_string(parsed.strftime("%Y-%m-%d %H:%M:%S"))
+    raise TemplateError(f"Invalid DateTime value: {value}")
+
+
+def _string(value=UNDEFINED, default=None, *args, **kwargs) -> str:
+    return _sql_string(_value(value, default, "String"))
+
+
+def _boolean(value=UNDEFINED, default=None, *args, **kwargs) -> bool:
+    value = _value(value, default, "Boolean")
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def _array(value=UNDEFINED, type="String", default=None, *args, **kwargs) -> str:
+    value = _value(value, default, "Array")
+    items = value if isinstance(value, list) else str(value).split(",")
+    helper = TEMPLATE_HELPERS.get(type, _string)
+    return "[" + ",".join(str(helper(item.strip())) for item in items) + "]"
+
+
+TEMPLATE_HELPERS = {
+    "defined": lambda value=UNDEFINED: value is not UNDEFINED,
+    "Boolean": _boolean,
+    "String": _string,
+    "DateTime": _datetime,
+    "Date": _datetime,
+    "Array": _array,
+    **{
+        name: _number(name, int)
+        for name in ("Int8", "Int16", "Int32", "Int64", "UInt8", "UInt16")
+        + ("UInt32", "UInt64")
+    },
+    **{name: _number(name, float) for name in ("Float32", "Float64")},
+}
+
+
+def render_template(sql: str, params: dict) -> str:
+    """Render the SQL of a node with the given request parameters.
+
+    Templates are the SQL blocks starting with `%`. Only `if/elif/else/end`
+    statements and `{{ }}` expressions are supported.
+    """
+    sql = sql.strip()
+    if not sql.startswith("%"):
+        return sql
+    # helpers are looked up first, so that parameters can't shadow them
+    namespace = _Params({**params, **TEMPLATE_HELPERS})
+    scope = {"__builtins__": {}}
+
+    def evaluate(expression: str):
+        try:
+            return eval(expression, scope, namespace)
+        except TemplateError:
+            raise
+        except (AttributeError, NameError, SyntaxError, TypeError, ValueError) as e:
+            raise TemplateError(f"Invalid template expression {expression}: {e}")
+
+    output: list[str] = []
+    # one (parent_active, branch_taken) entry for each open if statement
+    stack: list[tuple[bool, bool]] = []
+    active = True
+    for token in TEMPLATE_TOKEN_RE.split(sql[1:]):
+        if token.startswith("{%"):
+            keyword, _, expression = token[2:-2].strip().partition(" ")
+            if keyword == "if":
+                taken = active and bool(evaluate(expression))
+                stack.append((active, taken))
+                active = taken
+            elif keyword in ("elif", "else") and stack:
+                parent, taken = stack[-1]
+                active = parent and not taken
+                if keyword == "elif" and active:
+                    active = bool(evaluate(expression))
+                stack[-1] = (parent, taken or active)
+            elif keyword == "end" and stack:
+                active, _ = stack.pop()
+            else:
+                raise TemplateError(f"Unsupported template statement: {token}")
+        elif token.startswith("{{"):
+            if active:
+                output.append(str(evaluate(token[2:-2].strip())))
+        elif active:
+            output.append(token)
+    if stack:
+        raise TemplateError("Unclosed if statement in template")
+    return "".join(output).strip()
+
+
+class LocalTinybird:
+    """Tinybird datasources and pipes backed by chDB and local Parquet files.
+
+    Each datasource reads the Parquet files of `data_dir/<datasource>/`, and
+    the datasources written by materialized pipes are computed on the fly
+    from the SQL of those pipes.
+    """
+
+    def __init__(self, project_dir: str, data_dir: str):
+        self.data_dir = os.path.abspath(data_dir)
+        self.datasources: dict[str, list[tuple[str, str]]] = {}
+        self.pipes: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._session = chdb_session.Session()
+        self._session.query("SET session_timezone = 'UTC'")
+        for folder, _, files in sorted(os.walk(project_dir)):
+            for file_name in sorted(files):
+                name, ext = os.path.splitext(file_name)
+                if ext not in (".datasource", ".pipe"):
+                    continue
+                with open(os.path.join(folder, file_name), encoding="utf-8") as f:
+                    parsed = parse_datafile(f.read())
+                if ext == ".datasource":
+                    self.datasources[name] = schema_columns(parsed.get("SCHEMA", ""))
+                else:
+                    self.pipes[name] = parsed
+        materialized = {
+            node["DATASOURCE"]: node
+            for pipe in self.pipes.values()
+            for node in pipe["nodes"]
+            if node.get("TYPE", "").lower() == "materialized"
+        }
+        for name, columns in self.datasources.items():
+            if name not in materialized:
+                path = os.path.join(self.data_dir, name, "*.parquet")
+                self._session.query(
+                    f"CREATE VIEW {name} AS SELECT * FROM "
+                    f"file('{path}', Parquet, '{self._structure(columns)}')"
+                )
+        for name, node in materialized.items():
+            sql = render_template(node["SQL"], {})
+            self._session.query(f"CREATE VIEW {name} AS {sql}")
+        logger.info(
+            f"Local Tinybird with {len(self.datasources)} datasources and "
+            f"{len(self.pipes)} pipes, reading data from {self.data_dir}"
+        )
+
+    @staticmethod
+    def _structure(columns: list[tuple[str, str]]) -> str:
+        return ", ".join(f"{name} {type_}" for name, type_ in columns)
+
+    def _query(self, sql: str, fmt: str) -> bytes:
+        with self._lock:
+            return self._session.query(sql, fmt).bytes()
+
+    def pipe_sql(self, name: str, params: dict) -> str:
+        """SQL of an endpoint, previous nodes are used as subqueries."""
+        if name not in self.pipes:
+            raise KeyError(name)
+        nodes = self.pipes[name]["nodes"]
+        ctes = [
+            f"{node['name']} AS ({render_template(node['SQL'], params)})"
+            for node in nodes[:-1]
+        ]
+        sql = render_template(nodes[-1]["SQL"], params)
+        return f"WITH {', '.join(ctes)} {sql}" if ctes else sql
+
+    def query_pipe(self, name: str, params: dict, fmt: str = "csv") -> bytes:
+        return self._query(self.pipe_sql(name, params), FORMATS[fmt][0])
+
+    def append_events(self, name: str, body: bytes) -> int:
+        """Append NDJSON rows to a datasource, as a new Parquet file."""
+        if name not in self.datasources:
+            raise KeyError(name)
+        rows = sum(1 for line in body.splitlines() if line.strip())
+        if rows == 0:
+            return 0
+        os.makedirs(os.path.join(self.data_dir, name), exist_ok=True)
+        path = os.path.join(self.data_dir, name, f"events-{time.time_ns()}.parquet")
+        structure = self._structure(self.datasources[name])
+        ndjson = body.decode("utf-8").replace("$$", "")
+        self._query(
+            f"INSERT INTO FUNCTION file('{path}', Parquet, '{structure}') "
+            f"SELECT * FROM format(JSONEachRow, '{structure}', $${ndjson}$$) "
+            "SETTINGS input_format_skip_unknown_fields = 1",
+            "CSV",
+        )
+        return rows
+
+
+def make_handler(
+    tinybird: LocalTinybird, token: str | None = None, latency: float = 0.0
+):
+    """Request handler of the local Tinybird.
+
+    `latency` seconds are waited before answering each pipe request, to mimic
+    the round trip to the real Tinybird API.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status: int, message: str) -> None:
+            body = json.dumps({"error": message}).encode("utf-8")
+            self._send(status, body, "application/json")
+
+        def _params(self) -> dict:
+            query = urllib.parse.urlparse(self.path).query
+            return {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+
+        def _authorized(self, params: dict) -> bool:
+            if token is None:
+                return True
+            header = self.headers.get("Authorization", "")
+            return params.pop("token", None) == token or header == f"Bearer {token}"
+
+        def do_GET(self):
+            params = self._params()
+            if not self._authorized(params):
+                return self._error(403, "Invalid token")
+            params.pop("token", None)
+            match = PIPE_URL_RE.match(urllib.parse.urlparse(self.path).path)
+            if not match or match.group(2) not in FORMATS:
+                return self._error(404, f"Not found: {self.path}")
+            name, fmt = match.groups()
+            if latency:
+                time.sleep(latency)
+            try:
+                body = tinybird.query_pipe(name, params, fmt)
+            except KeyError:
+                return self._error(404, f"The pipe '{name}' does not exist")
+            except (TemplateError, RuntimeError) as e:
+                return self._error(400, str(e))
+            self._send(200, body, FORMATS[fmt][1])
+
+        def do_POST(self):
+            params = self._params()
+            if not self._authorized(params):
+                return self._error(403, "Invalid token")
+            if urllib.parse.urlparse(self.path).path != "/v0/events":
+                return self._error(404, f"Not found: {self.path}")
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                rows = tinybird.append_events(
+                    params.get("name", ""), self.rfile.read(length)
+                )
+            except KeyError:
+                return self._error(404, f"Datasource '{params.get('name')}' not found")
+            except RuntimeError as e:
+                return self._error(400, str(e))
+            body = json.dumps({"successful_rows": rows, "quarantined_rows": 0})
+            self._send(202, body.encode("utf-8"), "application/json")
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    return Handler
+
+
+def serve(
+    project_dir: str,
+    data_dir: str,
+    port: int = DEFAULT_PORT,
+    host: str = "127.0.0.1",
+    token: str | None = None,
+    latency: float = 0.0,
+) -> ThreadingHTTPServer:
+    """Create the HTTP server of the local Tinybird (not started yet)."""
+    tinybird = LocalTinybird(project_dir, data_dir)
+    return ThreadingHTTPServer((host, port), make_handler(tinybird, token, latency))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--project", default="../tinybird", help="tinybird folder")
+    parser.add_argument("--data", default="data", help="folder with Parquet files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--token", help="require this token (any token by default)")
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="added latency of pipe requests"
+    )
+    args = parser.parse_args()
+    server = serve(
+        args.project,
+        args.data,
+        args.port,
+        args.host,
+        args.token,
+        args.latency_ms / 1000,
+    )
+    logger.info(f"Local Tinybird listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
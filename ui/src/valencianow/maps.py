@@ -1,9 +1,15 @@
 """functions to build all the maps shown in the application"""
 
+import math
+from typing import TYPE_CHECKING
+
 import pandas as pd
-import pydeck as pdk
 
-from valencianow import config, data
+from valencianow import config, data, geo, metrics
+
+if TYPE_CHECKING:
+    # pydeck is imported where it is used, to keep the application start fast
+    import pydeck as pdk
 
 LABEL_BIKE, LABEL_CAR, LABEL_AIR = "bike", "car", "air"
 # approximated expected maximum values, to generate correct ranges
@@ -11,10 +17,47 @@ MAX_IH_BIKE, MAX_IH_CAR = 1000, 8000
 RADIUS_BIKE, RADIUS_CAR = 35, 15
 SCALE_BIKE, SCALE_CAR = 5, 0.5
 AGGREGATION = "MEAN"
+DEFAULT_ZOOM = 12
+# from this zoom level on, only the sensors in view are sent to the browser
+CULL_MIN_ZOOM = 14
+# approximated size (in pixels) of the map viewport, with some margin
+VIEWPORT_WIDTH_PX, VIEWPORT_HEIGHT_PX = 1200, 800
+WEB_MERCATOR_M_PER_PX = 156543.03392
+
+# a map view, given as (latitude, longitude, zoom)
+View = tuple[float, float, float]
+
+
+def _view_state(view: View | None, pitch: int = 0) -> "pdk.ViewState":
+    import pydeck as pdk
+
+    lat, lon, zoom = view or (config.VALENCIA_LAT, config.VALENCIA_LON, DEFAULT_ZOOM)
+    return pdk.ViewState(latitude=lat, longitude=lon, zoom=zoom, pitch=pitch)
 
 
-def balizas_icon_layer(balizas_df: pd.DataFrame) -> pdk.Layer:
+def in_view(rows: pd.DataFrame, view: View | None, label: str) -> pd.DataFrame:
+    """Keep only the rows whose sensors are visible with the given view.
+
+    Culling only happens at high zoom levels, where most of the sensors of
+    the city fall outside the viewport.
+    """
+    if view is None or view[2] < CULL_MIN_ZOOM:
+        return rows
+    lat, lon, zoom = view
+    m_per_px = WEB_MERCATOR_M_PER_PX * math.cos(math.radians(lat)) / 2**zoom
+    half_h = m_per_px * VIEWPORT_HEIGHT_PX / 2 / geo.EARTH_RADIUS_M
+    half_w = half_h * VIEWPORT_WIDTH_PX / VIEWPORT_HEIGHT_PX
+    d_lat = math.degrees(half_h)
+    d_lon = math.degrees(half_w / math.cos(math.radians(lat)))
+    index = geo.sensor_index(label, rows)
+    visible = index.in_bbox(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon)
+    return rows.loc[rows[data.COL_SENSOR].isin(visible.tolist())]
+
+
+def balizas_icon_layer(balizas_df: pd.DataFrame) -> "pdk.Layer":
     """IconLayer for displaying active balizas on the map."""
+    import pydeck as pdk
+
     return pdk.Layer(
         "IconLayer",
         data=balizas_df,
@@ -26,13 +69,19 @@ def balizas_icon_layer(balizas_df: pd.DataFrame) -> pdk.Layer:
     )
 
 
+@metrics.timed("build")
 def traffic_now_heatmap(
-    rows: pd.DataFrame, balizas_df: pd.DataFrame | None = None, is_bike=False
+    rows: pd.DataFrame,
+    balizas_df: pd.DataFrame | None = None,
+    is_bike=False,
+    view: View | None = None,
 ):
     """Heatmap with current traffic values"""
+    import pydeck as pdk
 
     max_ih = MAX_IH_BIKE if is_bike else MAX_IH_CAR
     radius = RADIUS_BIKE if is_bike else RADIUS_CAR
+    rows = in_view(rows, view, LABEL_BIKE if is_bike else LABEL_CAR)
 
     layers = [
         pdk.Layer(
@@ -56,20 +105,23 @@ def traffic_now_heatmap(
     return pdk.Deck(
         map_style="dark",
         map_provider="carto",
-        initial_view_state=pdk.ViewState(
-            latitude=config.VALENCIA_LAT, longitude=config.VALENCIA_LON, zoom=12
-        ),
+        initial_view_state=_view_state(view),
         layers=layers,
     )
 
 
-def traffic_now_elevation(rows: pd.DataFrame, is_bike=False) -> pdk.Deck:
+@metrics.timed("build")
+def traffic_now_elevation(
+    rows: pd.DataFrame, is_bike=False, view: View | None = None
+) -> "pdk.Deck":
     """Map with columns representing traffic values"""
+    import pydeck as pdk
 
     max_ih = MAX_IH_BIKE if is_bike else MAX_IH_CAR
     label = LABEL_BIKE if is_bike else LABEL_CAR
     scale = SCALE_BIKE if is_bike else SCALE_CAR
     radius = RADIUS_BIKE if is_bike else RADIUS_CAR
+    rows = in_view(rows, view, label)
 
     tooltip = (
         f"🔢 Sensor id: {{{data.COL_SENSOR}}} \n"
@@ -80,12 +132,7 @@ def traffic_now_elevation(rows: pd.DataFrame, is_bike=False) -> pdk.Deck:
         map_style="dark",
         map_provider="carto",
         tooltip={"text": tooltip},  # type: ignore
-        initial_view_state=pdk.ViewState(
-            latitude=config.VALENCIA_LAT,
-            longitude=config.VALENCIA_LON,
-            zoom=12,
-            pitch=40,
-        ),
+        initial_view_state=_view_state(view, pitch=40),
         layers=[
             pdk.Layer(
                 "ColumnLayer",
@@ -110,9 +157,14 @@ def traffic_now_elevation(rows: pd.DataFrame, is_bike=False) -> pdk.Deck:
     )
 
 
-def air_now_scatterplot(rows: pd.DataFrame):
+@metrics.timed("build")
+def air_now_scatterplot(rows: pd.DataFrame, view: View | None = None):
+    import pydeck as pdk
+
     # color recommendations taken from
     # https://www.miteco.gob.es/es/calidad-y-evaluacion-ambiental/temas/atmosfera-y-calidad-del-aire/calidad-del-aire/ica.html
+    # (on a copy, the snapshot is shared by all sessions)
+    rows = rows.copy()
     rows["color"] = rows["ica"].map(
         {
             6: [56, 162, 206],
@@ -127,9 +179,7 @@ def air_now_scatterplot(rows: pd.DataFrame):
     return pdk.Deck(
         map_style="dark",
         map_provider="carto",
-        initial_view_state=pdk.ViewState(
-            latitude=config.VALENCIA_LAT, longitude=config.VALENCIA_LON, zoom=12
-        ),
+        initial_view_state=_view_state(view),
         tooltip={"text": tooltip},  # type: ignore
         layers=[
             pdk.Layer(
@@ -0,0 +1,246 @@
+"""lightweight instrumentation of the application hot paths.
+
+Timing spans (network, parse, normalize, build, render, and the whole load
+of each pipe) and counters (bytes received, rows, cache requests) are kept
+in memory, logged as JSON lines and exported in the Prometheus text format.
+Set VALENCIANOW_METRICS_PORT to serve them on /metrics (and a per-pipe
+latency summary on /metrics.json).
+"""
+
+import bisect
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from valencianow import config
+
+logger = logging.getLogger("valencianow.metrics")
+# span logs are DEBUG, set to DEBUG to get a JSON line for every stage
+logger.setLevel(os.environ.get("VALENCIANOW_METRICS_LOG_LEVEL", "INFO"))
+
+STAGE_SECONDS = "valencianow_stage_seconds"
+RECEIVED_BYTES = "valencianow_received_bytes_total"
+ROWS = "valencianow_rows_total"
+CACHE_REQUESTS = "valencianow_cache_requests_total"
+# upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# number of recent observations kept to compute percentiles
+RESERVOIR_SIZE = 512
+QUANTILES = (0.5, 0.95)
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple], float] = collections.defaultdict(float)
+_histograms: dict[tuple[str, tuple], "_Histogram"] = {}
+_server: ThreadingHTTPServer | None = None
+# set when the port could not be bound, so that it isn't retried on every rerun
+_server_failed = False
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: collections.deque = collections.deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        values = sorted(self.recent)
+        return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def _key(name: str, labels: dict) -> tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increase a counter."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation to a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = _Histogram()
+        _histograms[key].observe(value)
+
+
+@contextmanager
+def span(stage: str, level: int = logging.DEBUG, **labels):
+    """Time a stage of the application (network, parse, normalize, ...).
+
+    Yields a dict where the block can add fields (like the number of rows)
+    to the JSON line logged when the stage ends.
+    """
+    fields: dict = {}
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(STAGE_SECONDS, elapsed, stage=stage, **labels)
+        if logger.isEnabledFor(level):
+            event = {"event": "span", "stage": stage, **labels, **fields}
+            logger.log(
+                level,
+                json.dumps({**event, "ms": round(elapsed * 1000, 3)}, default=str),
+            )
+
+
+def timed(stage: str, **labels):
+    """Decorator timing every call of a function as a span.
+
+    The function name is used as the `target` label by default.
+    """
+
+    def decorator(func):
+        span_labels = {"target": func.__name__, **labels}
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **span_labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def stage_summary(stage: str) -> dict[str, dict[str, float]]:
+    """Count and p50/p95 latency (in ms) of a stage, by pipe (or target)."""
+    summary = {}
+    with _lock:
+        for (name, labels), histogram in _histograms.items():
+            label_dict = dict(labels)
+            if name != STAGE_SECONDS or label_dict.get("stage") != stage:
+                continue
+            key = label_dict.get("pipe", label_dict.get("target", ""))
+            summary[key] = {
+                "count": histogram.count,
+                **{
+                    f"p{int(q * 100)}_ms": round(histogram.quantile(q) * 1000, 1)
+                    for q in QUANTILES
+                },
+            }
+    return dict(sorted(summary.items()))
+
+
+def latency_summary() -> dict[str, dict[str, float]]:
+    """p50/p95 latency (in ms) and number of loads of each pipe."""
+    return stage_summary("load")
+
+
+def counter_totals(name: str) -> dict[str, float]:
+    """Values of a counter, by pipe."""
+    with _lock:
+        return {
+            dict(labels).get("pipe", ""): value
+            for (counter_name, labels), value in sorted(_counters.items())
+            if counter_name == name
+        }
+
+
+def _labels(labels: tuple, **extra) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus() -> str:
+    """All the metrics, in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+    for name in sorted({name for (name, _), _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (counter_name, labels), value in counters:
+            if counter_name == name:
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+    for name in sorted({name for (name, _), _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (histogram_name, labels), histogram in histograms:
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram.bucket_counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        lines.append(f"# TYPE {name}_recent summary")
+        for (histogram_name, labels), histogram in histograms:
+            if histogram_name == name:
+                for q in QUANTILES:
+                    value = histogram.quantile(q)
+                    lines.append(
+                        f"{name}_recent{_labels(labels, quantile=q)} {value:g}"
+                    )
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """Forget all the recorded metrics."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(latency_summary(), indent=2).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> None:
+    """Serve the metrics if VALENCIANOW_METRICS_PORT is set.
+
+    Streamlit runs the application script on every rerun, so the server is
+    only started the first time. If the port is taken (like with several
+    workers on the same host), the application runs without serving them.
+    """
+    global _server, _server_failed
+    port = os.environ.get("VALENCIANOW_METRICS_PORT")
+    if not port or _server is not None or _server_failed:
+        return
+    with _lock:
+        if _server is not None or _server_failed:
+            return
+        try:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+        except OSError as e:
+            _server_failed = True
+            config.logger.warning(f"Not serving metrics on port {port}: {e}")
+            return
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    config.logger.info(f"Serving metrics on port {port}")
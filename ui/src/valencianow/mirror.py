@@ -0,0 +1,387 @@
+"""local mirror of the car, bike and air history.
+
+Historical readings never change, so when VALENCIANOW_MIRROR_DIR is set the
+history (sensor, time and value of every reading) is kept there as Parquet
+files partitioned by month, and the *_history, *_per_day and *_per_day_of_week
+queries whose range is covered are answered from it. Only the readings newer
+than the watermark of each datasource are requested to Tinybird, at most
+every SYNC_INTERVAL, in the background: Tinybird answers the queries that
+reach the latest readings meanwhile. Fill the mirror with:
+
+    python -m valencianow.mirror --days 365
+
+Readings are published up to PUBLISH_DELAY after their time, so the mirror
+may lack some of the last PUBLISH_DELAY before the watermark (like
+Tinybird itself), until the next sync requests them again. Readings
+published later than that, like after an outage of the append workflows,
+are never mirrored: request them again with a longer overlap, like
+`python -m valencianow.mirror --overlap-hours 48`.
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+
+from valencianow import config, data, metrics
+
+logger = config.logger
+
+MIRROR_DIR = os.environ.get("VALENCIANOW_MIRROR_DIR", "")
+# mirrored datasources, by the sensor type of their pipes
+DATASOURCES = {config.TAB_CAR: "cars", config.TAB_BIKE: "bikes", config.TAB_AIR: "air"}
+# pipes answered by the mirror: (sensor type, kind of pipe)
+MIRRORED_PIPES = {
+    info[kind]: (label, kind)
+    for label, info in data.TB_PIPES.items()
+    for kind in (data.TB_HIST_PIPE, data.TB_PER_DAY_PIPE, data.TB_PER_DOW_PIPE)
+}
+# seconds after which the latest readings are requested again. The append
+# workflows run every 30 minutes, more frequent syncs would find nothing new
+SYNC_INTERVAL = 30 * 60
+# readings reach Tinybird at most this long after their time (one append
+# interval, plus the delay of the scheduled workflows), so each sync also
+# requests again the readings of this long before the watermark
+PUBLISH_DELAY = datetime.timedelta(hours=1)
+# range of each request when filling the mirror
+SYNC_WINDOW = datetime.timedelta(days=1)
+DEFAULT_DAYS = 365
+# a month partition is compacted into a single file when it has more files
+COMPACT_FILES = 16
+# files are sorted by sensor, so that the statistics of their row groups let
+# the readings of a few sensors be read without scanning the whole month
+ROW_GROUP_SIZE = 8192
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_locks = {label: threading.Lock() for label in DATASOURCES}
+# background syncs of this process, by sensor type
+_syncing: dict[str, threading.Thread] = {}
+_syncing_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(MIRROR_DIR)
+
+
+def _dir(label: str) -> str:
+    return os.path.join(MIRROR_DIR, DATASOURCES[label])
+
+
+def _columns(label: str) -> tuple[str, str, str]:
+    """Sensor, datetime and value columns, named like in Tinybird."""
+    info = data.TB_PIPES[label]
+    return info[data.TB_SENSOR_COL], info[data.TB_DATETIME_COL], info[data.TB_HIST_Y]
+
+
+def _schema(label: str) -> pa.Schema:
+    sensor_col, datetime_col, value_col = _columns(label)
+    return pa.schema(
+        [
+            (sensor_col, pa.int64()),
+            (datetime_col, pa.timestamp("s")),
+            (value_col, pa.int64()),
+        ]
+    )
+
+
+@contextlib.contextmanager
+def _locked(label: str, exclusive: bool, name: str = ".lock"):
+    """Lock of a datasource, shared by readers and exclusive for writers
+    (in this and in other processes).
+
+    Syncs are serialized by a separate lock (".sync.lock"), so that readers
+    only wait for their writes, not for their Tinybird requests.
+    """
+    os.makedirs(_dir(label), exist_ok=True)
+    with open(os.path.join(_dir(label), name), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def state(label: str) -> dict | None:
+    """First and last (watermark) mirrored times of a datasource, and the
+    time of its last sync. None if it has not been filled."""
+    try:
+        with open(os.path.join(_dir(label), "state.json"), encoding="utf-8") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {
+        "since": datetime.datetime.strptime(saved["since"], DATE_FORMAT),
+        "watermark": datetime.datetime.strptime(saved["watermark"], DATE_FORMAT),
+        "synced_at": saved["synced_at"],
+    }
+
+
+def _save_state(label: str, since: datetime.datetime, watermark: datetime.datetime):
+    path = os.path.join(_dir(label), "state.json")
+    saved = {
+        "since": since.strftime(DATE_FORMAT),
+        "watermark": watermark.strftime(DATE_FORMAT),
+        "synced_at": time.time(),
+    }
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(saved, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _files(
+    label: str, start: datetime.datetime, end: datetime.datetime | None = None
+) -> list[str]:
+    """Parquet files of the month partitions between start and end."""
+    files = []
+    for partition in sorted(os.listdir(_dir(label))):
+        if not partition.startswith("month="):
+            continue
+        month = partition.removeprefix("month=")
+        if month >= f"{start:%Y-%m}" and (end is None or month <= f"{end:%Y-%m}"):
+            path = os.path.join(_dir(label), partition)
+            files += [
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(".parquet")
+            ]
+    return files
+
+
+def _read(
+    label: str,
+    start: datetime.datetime,
+    end: datetime.datetime | None = None,
+    sensors: list[int] | None = None,
+) -> pd.DataFrame:
+    sensor_col, datetime_col, _ = _columns(label)
+    condition = ds.field(datetime_col) >= pa.scalar(start, pa.timestamp("s"))
+    if end is not None:
+        condition &= ds.field(datetime_col) <= pa.scalar(end, pa.timestamp("s"))
+    if sensors is not None:
+        condition &= ds.field(sensor_col).isin(sensors)
+    files = _files(label, start, end)
+    dataset = ds.dataset(files, schema=_schema(label), format="parquet")
+    return dataset.to_table(filter=condition).to_pandas()
+
+
+def _write_file(label: str, path: str, table: pa.Table) -> None:
+    sensor_col, datetime_col, _ = _columns(label)
+    table = table.sort_by([(sensor_col, "ascending"), (datetime_col, "ascending")])
+    name = f"{time.time_ns()}-{os.getpid()}.parquet"
+    pq.write_table(
+        table, os.path.join(path, f".{name}.tmp"), row_group_size=ROW_GROUP_SIZE
+    )
+    os.replace(os.path.join(path, f".{name}.tmp"), os.path.join(path, name))
+
+
+def write(label: str, readings: pd.DataFrame) -> None:
+    """Add readings to their month partitions."""
+    _, datetime_col, _ = _columns(label)
+    months = readings[datetime_col].dt.strftime("%Y-%m")
+    for month, month_rows in readings.groupby(months):
+        path = os.path.join(_dir(label), f"month={month}")
+        os.makedirs(path, exist_ok=True)
+        table = pa.Table.from_pandas(
+            month_rows, schema=_schema(label), preserve_index=False
+        )
+        _write_file(label, path, table)
+        _compact(label, path)
+
+
+def _compact(label: str, path: str) -> None:
+    files = sorted(name for name in os.listdir(path) if name.endswith(".parquet"))
+    if len(files) <= COMPACT_FILES:
+        return
+    _write_file(label, path, pq.read_table([os.path.join(path, f) for f in files]))
+    for name in files:
+        os.remove(os.path.join(path, name))
+
+
+def to_readings(label: str, response: pd.DataFrame) -> pd.DataFrame:
+    """Readings to mirror from a lean response of a history pipe."""
+    sensor_col, datetime_col, value_col = _columns(label)
+    readings = response.loc[:, [sensor_col, datetime_col, value_col]].copy()
+    readings[datetime_col] = pd.to_datetime(readings[datetime_col])
+    readings[value_col] = readings[value_col].astype("Int64")
+    return readings
+
+
+def _fetch_window(
+    label: str, start: datetime.datetime, end: datetime.datetime
+) -> pd.DataFrame:
+    """Readings of all the sensors between start (included) and end."""
+    params = {
+        "lean": "true",
+        "min_date": start.strftime(DATE_FORMAT),
+        "max_date": (end - datetime.timedelta(seconds=1)).strftime(DATE_FORMAT),
+    }
+    return to_readings(
+        label, data._fetch(data.TB_PIPES[label][data.TB_HIST_PIPE], params)
+    )
+
+
+def sync(
+    label: str,
+    days: int = DEFAULT_DAYS,
+    min_interval: float = 0,
+    overlap: datetime.timedelta = PUBLISH_DELAY,
+) -> int:
+    """Request the readings newer than the watermark of a datasource, and the
+    missing ones of the `overlap` before it.
+
+    An empty mirror is filled with the last `days` of readings. Nothing is
+    requested if it was synced less than `min_interval` seconds ago (like by
+    another process while waiting for the lock). Returns the number of
+    readings added.
+    """
+    sensor_col, datetime_col, _ = _columns(label)
+    with _locks[label], _locked(label, exclusive=True, name=".sync.lock"):
+        current = state(label)
+        if current is not None and time.time() - current["synced_at"] < min_interval:
+            return 0
+        now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None, microsecond=0)
+        if current is None:
+            since = start = now - datetime.timedelta(days=days)
+        else:
+            since = current["since"]
+            start = max(since, current["watermark"] - overlap)
+        added = 0
+        while start < now:
+            end = min(start + SYNC_WINDOW, now)
+            readings = _fetch_window(label, start, end)
+            if current is not None and start < current["watermark"]:
+                # readings of the overlap that are already mirrored. Only
+                # syncs write, so they can be read without the data lock
+                known = _read(label, start, current["watermark"])
+                keys = [sensor_col, datetime_col]
+                known_index = pd.MultiIndex.from_frame(known.loc[:, keys])
+                new = ~pd.MultiIndex.from_frame(readings.loc[:, keys]).isin(known_index)
+                readings = readings.loc[new]
+            with _locked(label, exclusive=True):
+                if len(readings) > 0:
+                    write(label, readings)
+                _save_state(label, since, end - datetime.timedelta(seconds=1))
+            added += len(readings)
+            start = end
+    logger.info(f"Mirrored {added} new {DATASOURCES[label]} readings")
+    return added
+
+
+def _covered(
+    label: str, start: datetime.datetime, end: datetime.datetime | None
+) -> bool:
+    """Whether the mirror has all the readings of the range, synced if the
+    range reaches the latest readings.
+
+    Readings of the last PUBLISH_DELAY before the watermark published after
+    the last sync are missing until the next one, at most SYNC_INTERVAL
+    later. Those published later than PUBLISH_DELAY are never mirrored (see
+    the module docstring).
+    """
+    current = state(label)
+    if current is None or start < current["since"]:
+        return False
+    if end is not None and end <= current["watermark"]:
+        return True
+    if time.time() - current["synced_at"] > SYNC_INTERVAL:
+        sync_in_background(label)
+        return False
+    return end is None or end <= current["watermark"]
+
+
+def sync_in_background(label: str) -> None:
+    """Start a sync of a datasource in a thread, unless one is running."""
+    with _syncing_lock:
+        running = _syncing.get(label)
+        if running is not None and running.is_alive():
+            return
+        thread = threading.Thread(target=_background_sync, args=(label,), daemon=True)
+        _syncing[label] = thread
+        thread.start()
+
+
+def _background_sync(label: str) -> None:
+    try:
+        # other processes may start a sync at the same time, only one of
+        # them requests the latest readings
+        sync(label, min_interval=SYNC_INTERVAL)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logger.warning(f"Could not sync the {DATASOURCES[label]} mirror: {e}")
+
+
+def query(pipe_name: str, params: dict) -> pd.DataFrame | None:
+    """Response of a history pipe computed from the mirror, with the columns
+    returned by Tinybird. None if the pipe or the range are not mirrored."""
+    if pipe_name not in MIRRORED_PIPES or "min_date" not in params:
+        return None
+    label, kind = MIRRORED_PIPES[pipe_name]
+    info = data.TB_PIPES[label]
+    _, datetime_col, value_col = _columns(label)
+    sensor_params = {info[data.TB_SENSOR_PARAM], info[data.TB_SENSORS_PARAM]}
+    if set(params) - {"min_date", "max_date", "lean", *sensor_params}:
+        return None
+    # geo_point_2d is not mirrored, lean responses don't have it
+    if kind == data.TB_HIST_PIPE and params.get("lean") != "true":
+        return None
+    start = datetime.datetime.strptime(params["min_date"], DATE_FORMAT)
+    end = None
+    if "max_date" in params:
+        end = datetime.datetime.strptime(params["max_date"], DATE_FORMAT)
+    if not _covered(label, start, end):
+        return None
+    sensors = None
+    if info[data.TB_SENSOR_PARAM] in params:
+        sensors = [int(params[info[data.TB_SENSOR_PARAM]])]
+    if info[data.TB_SENSORS_PARAM] in params:
+        sensors = [int(s) for s in params[info[data.TB_SENSORS_PARAM]].split(",")]
+    with metrics.span("mirror", pipe=pipe_name), _locked(label, exclusive=False):
+        rows = _read(label, start, end, sensors)
+    if kind == data.TB_HIST_PIPE:
+        return rows.sort_values(datetime_col, kind="stable", ignore_index=True)
+    # the *_per_day* pipes average the readings by UTC day (or weekday)
+    if kind == data.TB_PER_DAY_PIPE:
+        keys = rows[datetime_col].dt.floor("D").rename(data.COL_DAY)
+        y_axis = info[data.TB_PER_DAY_Y]
+    else:
+        keys = (rows[datetime_col].dt.dayofweek + 1).astype("int64")
+        keys = keys.rename("day_of_week")
+        y_axis = info[data.TB_PER_DOW_Y]
+    averages = rows[value_col].groupby(keys).mean().to_frame(y_axis).reset_index()
+    if kind == data.TB_PER_DAY_PIPE:
+        averages[data.COL_DAY] = averages[data.COL_DAY].dt.strftime("%Y-%m-%d")
+    return averages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--days", type=int, default=DEFAULT_DAYS, help="days of history of a new mirror"
+    )
+    parser.add_argument("--datasources", nargs="+", default=list(DATASOURCES.values()))
+    parser.add_argument(
+        "--overlap-hours",
+        type=float,
+        default=PUBLISH_DELAY / datetime.timedelta(hours=1),
+        help="hours before the watermark whose missing readings are requested",
+    )
+    args = parser.parse_args()
+    if not enabled():
+        parser.error("set VALENCIANOW_MIRROR_DIR to the mirror directory")
+    config.validate()
+    for label, datasource in DATASOURCES.items():
+        if datasource in args.datasources:
+            sync(label, args.days, overlap=datetime.timedelta(hours=args.overlap_hours))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""cache of processed dataframes shared by several application processes.
+
+When VALENCIANOW_SHARED_CACHE_DIR is set to a directory shared by all the
+workers (ideally in memory, like /dev/shm), the latest snapshots and the
+history results are stored there as Arrow IPC files instead of in each
+process. Workers memory-map them, and the numeric columns without missing
+values are read-only views of the mapped pages, which are shared by all of
+them (text columns and those with missing values are still copied into each
+worker). A lock file next to each snapshot elects a single worker to refresh
+it when it expires, while the others keep reading the previous one.
+Snapshots that are not requested any more are deleted when a worker
+refreshes another one.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import threading
+import time
+from collections.abc import Callable
+
+import pandas as pd
+import pyarrow as pa
+
+from valencianow import config, metrics
+
+logger = config.logger
+
+CACHE_DIR = os.environ.get("VALENCIANOW_SHARED_CACHE_DIR", "")
+# readable part of the file names, the rest is a hash of the whole key
+MAX_NAME_LENGTH = 80
+# snapshots not refreshed for this many TTLs are not being requested any more
+EVICT_AFTER_TTLS = 3
+
+Loader = Callable[[], pd.DataFrame | None]
+
+
+def enabled() -> bool:
+    return bool(CACHE_DIR)
+
+
+def path(key: str) -> str:
+    """Arrow IPC file of a snapshot."""
+    name = re.sub(r"[^\w.-]", "_", key)[:MAX_NAME_LENGTH]
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{name}-{digest}.arrow")
+
+
+def read(key: str) -> tuple[pd.DataFrame | None, float] | None:
+    """The stored snapshot (None if it had no rows) and its age in seconds.
+
+    None is returned if it is not stored yet.
+    """
+    try:
+        source = pa.memory_map(path(key))
+    except FileNotFoundError:
+        return None
+    age = time.time() - os.fstat(source.fileno()).st_mtime
+    with metrics.span("shared_read", pipe=key.split("|", 1)[0]):
+        # one block per column, so numeric columns without nulls are
+        # (read-only) views of the mapped file instead of being consolidated
+        # into new arrays. The file stays mapped while they are referenced
+        table = pa.ipc.open_file(source).read_all()
+        df = (
+            table.to_pandas(split_blocks=True, self_destruct=False)
+            if table.num_rows > 0
+            else None
+        )
+    return df, age
+
+
+def write(key: str, df: pd.DataFrame | None) -> None:
+    """Store a snapshot. Readers see either the previous file or the new one."""
+    table = pa.Table.from_pandas(df if df is not None else pd.DataFrame())
+    target = path(key)
+    tmp = f"{target}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as w:
+            w.write_table(table)
+        os.replace(tmp, target)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+
+def get(key: str, load: Loader, ttl: float) -> pd.DataFrame | None:
+    """Stored snapshot of the given key, loaded again if older than ttl.
+
+    Only one worker (or thread) loads an expired snapshot. The others return
+    the expired one meanwhile, or wait for it if there is none yet.
+    """
+    pipe = key.split("|", 1)[0]
+    stored = read(key)
+    if stored is not None and stored[1] < ttl:
+        metrics.inc(metrics.CACHE_REQUESTS, pipe=pipe, result="hit")
+        return stored[0]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(f"{path(key)}.lock", "a") as lock:
+        if stored is None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        else:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                metrics.inc(metrics.CACHE_REQUESTS, pipe=pipe, result="stale")
+                return stored[0]
+        try:
+            # it may have been refreshed while waiting for the lock
+            stored = read(key)
+            if stored is not None and stored[1] < ttl:
+                metrics.inc(metrics.CACHE_REQUESTS, pipe=pipe, result="hit")
+                return stored[0]
+            metrics.inc(metrics.CACHE_REQUESTS, pipe=pipe, result="miss")
+            df = load()
+            write(key, df)
+            sweep(EVICT_AFTER_TTLS * ttl)
+            return df
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def sweep(max_age: float) -> int:
+    """Delete the snapshots (and their lock files) older than max_age seconds,
+    and the temporary files left by interrupted writes.
+
+    Snapshots being refreshed are kept. Returns the number of deleted ones.
+    """
+    deleted = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".arrow"):
+            target = entry.path
+        elif entry.name.endswith(".arrow.lock"):
+            # lock files of snapshots that were never stored
+            target = entry.path.removesuffix(".lock")
+            if os.path.exists(target):
+                continue
+        elif entry.name.endswith(".tmp"):
+            if _age(entry.path) >= max_age:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+            continue
+        else:
+            continue
+        if _age(entry.path) >= max_age and _evict(target, max_age):
+            deleted += 1
+    if deleted:
+        logger.info(f"Deleted {deleted} expired snapshots from {CACHE_DIR}")
+    return deleted
+
+
+def _age(file: str) -> float:
+    try:
+        return time.time() - os.stat(file).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def _evict(target: str, max_age: float) -> bool:
+    """Delete a snapshot and its lock file, unless it is being refreshed."""
+    with open(f"{target}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            # it may have been refreshed before taking the lock
+            if os.path.exists(target) and _age(target) < max_age:
+                return False
+            # a worker that opened the lock file before it is deleted can
+            # still take it, at worst loading the snapshot twice
+            for file in (target, f"{target}.lock"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(file)
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
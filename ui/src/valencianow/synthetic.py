@@ -0,0 +1,231 @@
+"""synthetic car, bike and air readings shaped like the Tinybird datasources,
+to develop and benchmark the application without the real data"""
+
+import argparse
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from valencianow import config, data
+
+logger = config.logger
+
+DATASOURCES = ("cars", "bikes", "air")
+# number of sensors of each datasource in production (approximately)
+N_SENSORS = {"cars": 1200, "bikes": 150, "air": 11}
+SENSOR_TYPES = {"cars": config.TAB_CAR, "bikes": config.TAB_BIKE, "air": config.TAB_AIR}
+# all datasources are appended every 30 minutes
+INTERVAL = "30min"
+# typical (median) number of vehicles per hour of a sensor
+MEDIAN_IH = {"cars": 600, "bikes": 60}
+# relative traffic for each hour of the day (Spain local time)
+HOURLY_PROFILE = np.array(
+    [0.25, 0.15, 0.1, 0.08, 0.1, 0.2, 0.5, 1.1, 1.5, 1.2, 1.0, 1.0,
+     1.05, 1.1, 1.2, 1.0, 1.0, 1.15, 1.4, 1.35, 1.0, 0.7, 0.5, 0.35]
+)  # fmt: skip
+# relative traffic for each day of the week, starting on Monday
+WEEKDAY_PROFILE = np.array([1.0, 1.02, 1.03, 1.05, 1.1, 0.75, 0.6])
+AIR_QUALITY = [
+    # (max no2 in µg/m3, calidad_ambiental)
+    (40, "Buena"),
+    (90, "Razonablemente Buena"),
+    (120, "Regular"),
+    (230, "Desfavorable"),
+    (340, "Muy desfavorable"),
+    (np.inf, "Peligrosa"),
+]
+
+
+def sensors(datasource: str, n: int | None = None, seed: int = 0) -> pd.DataFrame:
+    """Sensor ids, positions and relative traffic level of a datasource.
+
+    Known sensors (from the sensor addresses file) come first, more sensors are
+    made up around the city center until there are `n` of them.
+    """
+    n = N_SENSORS[datasource] if n is None else n
+    rng = np.random.default_rng(seed)
+    ids, lats, lons = data.sensor_locations(SENSOR_TYPES[datasource])
+    ids, lats, lons = ids[:n], lats[:n], lons[:n]
+    missing = n - len(ids)
+    if missing > 0:
+        first_id = int(ids.max()) + 1 if len(ids) else 1
+        ids = np.concatenate([ids, np.arange(first_id, first_id + missing)])
+        lats = np.concatenate(
+            [lats, config.VALENCIA_LAT + rng.normal(0, 0.015, missing)]
+        )
+        lons = np.concatenate(
+            [lons, config.VALENCIA_LON + rng.normal(0, 0.02, missing)]
+        )
+    return pd.DataFrame(
+        {
+            "id": ids,
+            data.COL_LAT: lats,
+            data.COL_LON: lons,
+            "level": rng.lognormal(0, 0.8, n),
+        }
+    )
+
+
+def _timestamps(start: datetime.datetime, end: datetime.datetime) -> pd.DatetimeIndex:
+    """UTC timestamps of all the snapshots in [start, end)."""
+    first = pd.to_datetime(start).ceil(INTERVAL)
+    return pd.date_range(first, end, freq=INTERVAL, inclusive="left")
+
+
+def _traffic_level(times: pd.DatetimeIndex) -> np.ndarray:
+    local = times.tz_localize("UTC").tz_convert("Europe/Madrid").to_series().dt
+    return HOURLY_PROFILE[local.hour] * WEEKDAY_PROFILE[local.dayofweek]
+
+
+def traffic_readings(
+    datasource: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    sensor_df: pd.DataFrame,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Rows of the cars or bikes datasource, one per sensor and snapshot."""
+    rng = np.random.default_rng(seed)
+    times = _timestamps(start, end)
+    n_times, n_sensors = len(times), len(sensor_df)
+    base = MEDIAN_IH[datasource] * sensor_df["level"].to_numpy()
+    level = np.outer(_traffic_level(times), base)
+    ih = np.rint(level * rng.lognormal(0, 0.15, level.shape)).astype(np.int32)
+    ih = pd.array(ih.ravel(), dtype="Int32")
+    if datasource == "bikes":
+        # some bike sensors don't report a value in every snapshot
+        ih[rng.random(len(ih)) < 0.03] = pd.NA
+    geo_points = (
+        sensor_df[data.COL_LAT].astype(str) + "," + sensor_df[data.COL_LON].astype(str)
+    ).to_numpy()
+    return pd.DataFrame(
+        {
+            "last_edited_date": np.repeat(times.to_numpy(), n_sensors),
+            "idpm": np.tile(sensor_df["id"].to_numpy(np.int32), n_times),
+            "ih": ih,
+            "geo_point_2d": np.tile(geo_points, n_times),
+        }
+    )
+
+
+def air_readings(
+    start: datetime.datetime,
+    end: datetime.datetime,
+    sensor_df: pd.DataFrame,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Rows of the air datasource, one per station and snapshot."""
+    rng = np.random.default_rng(seed)
+    times = _timestamps(start, end)
+    n_times, n_sensors = len(times), len(sensor_df)
+    shape = (n_times, n_sensors)
+    traffic = np.repeat(_traffic_level(times), n_sensors).reshape(shape)
+
+    def pollutant(median: float, traffic_weight: float) -> np.ndarray:
+        level = median * (1 - traffic_weight + traffic_weight * traffic)
+        return (level * rng.lognormal(0, 0.3, shape)).astype(np.float32).ravel()
+
+    no2 = pollutant(35, 0.9)
+    quality = np.array([label for _, label in AIR_QUALITY])
+    thresholds = np.array([limit for limit, _ in AIR_QUALITY])
+    lats = sensor_df[data.COL_LAT].to_numpy()
+    lons = sensor_df[data.COL_LON].to_numpy()
+    geo_points = np.array([f"{lat},{lon}" for lat, lon in zip(lats, lons)])
+    geo_shapes = np.array(
+        [
+            f'{{"coordinates": [{lon}, {lat}], "type": "Point"}}'
+            for lat, lon in zip(lats, lons)
+        ]
+    )
+    names = np.array([f"Estación {sid}" for sid in sensor_df["id"]])
+    return pd.DataFrame(
+        {
+            "_objectid": np.tile(sensor_df["id"].to_numpy(np.int16), n_times),
+            "nom___nombre": np.tile(names, n_times),
+            "adre_a___direccion": np.tile(names, n_times),
+            "tipus_zona___tipo_zona": "Urbana",
+            "par_metres___par_metros": "SO2, NO2, O3, CO, PM10, PM2.5",
+            "mesuraments___mediciones": pd.array(
+                [None] * n_times * n_sensors, dtype="string"
+            ),
+            "so2": pollutant(4, 0.2),
+            "no2": no2,
+            "o3": pollutant(60, -0.3),
+            "co": pollutant(0.3, 0.7),
+            "pm10": pollutant(20, 0.5),
+            "pm25": pollutant(10, 0.5),
+            "tipoemision": "Tráfico",
+            "fecha_carga": np.repeat(times.to_numpy(), n_sensors),
+            "calidad_ambiental": quality[np.searchsorted(thresholds, no2)],
+            "fiwareid": np.tile(names, n_times),
+            "geo_shape": np.tile(geo_shapes, n_times),
+            "geo_point_2d": np.tile(geo_points, n_times),
+        }
+    )
+
+
+def readings(
+    datasource: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    n_sensors: int | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Synthetic rows of a datasource for all the snapshots in [start, end)."""
+    sensor_df = sensors(datasource, n_sensors)
+    if datasource == "air":
+        return air_readings(start, end, sensor_df, seed)
+    return traffic_readings(datasource, start, end, sensor_df, seed)
+
+
+def _months(start: datetime.datetime, end: datetime.datetime):
+    current = start
+    while current < end:
+        next_month = (current.replace(day=1) + datetime.timedelta(days=32)).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        yield current, min(next_month, end)
+        current = next_month
+
+
+def write_parquet(
+    out_dir: str,
+    datasource: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    n_sensors: int | None = None,
+    seed: int = 0,
+) -> int:
+    """Write synthetic readings as one Parquet file per month.
+
+    Files are written to `out_dir/<datasource>/`, where the local Tinybird
+    stand-in (valencianow.localbird) reads them from.
+    """
+    os.makedirs(os.path.join(out_dir, datasource), exist_ok=True)
+    total = 0
+    for i, (month_start, month_end) in enumerate(_months(start, end)):
+        df = readings(datasource, month_start, month_end, n_sensors, seed + i)
+        path = os.path.join(out_dir, datasource, f"{month_start:%Y-%m}.parquet")
+        df.to_parquet(path, index=False)
+        logger.info(f"Written {len(df)} {datasource} rows to {path}")
+        total += len(df)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--out", default="data", help="output directory")
+    parser.add_argument("--days", type=int, default=365, help="days of history")
+    parser.add_argument("--datasources", nargs="+", default=list(DATASOURCES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    end = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+    start = end - datetime.timedelta(days=args.days)
+    for datasource in args.datasources:
+        write_parquet(args.out, datasource, start, end, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()